@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
+from collections import deque
 import cv_bridge
+import queue
+import threading
+import time
 import rospy
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 from sensor_msgs.msg import CameraInfo, Image, PointCloud2
 import std_srvs.srv
 
@@ -18,10 +23,14 @@ class UniformTSDFServer:
         print("Initializing TSDF Server")
         self.load_parameters()
         tf.init()
-        self.init_topics()
-        self.advertise_services()
         self.cv_bridge = cv_bridge.CvBridge()
         self.integrate = False
+        # Clouds are served from snapshots that are only re-extracted when the map changed
+        self.integration_count = 0
+        self.snapshots = {}
+        self.init_pipeline()
+        self.init_topics()
+        self.advertise_services()
         print("TSDF server ready")
         # pub_topics = rospy.get_published_topics()
         # print(f"Publishing to: {pub_topics}")
@@ -37,6 +46,11 @@ class UniformTSDFServer:
         self.cam_frame_id = rospy.get_param("~camera/frame_id")
         info_topic = rospy.get_param("~camera/info_topic")
         self.depth_topic = rospy.get_param("~camera/depth_topic")
+        self.cloud_rate = rospy.get_param("~cloud_rate", 5.0)  # max snapshot extractions per second
+        self.map_cloud_decimation = rospy.get_param("~map_cloud_decimation", 0.0)  # voxel size, 0 to disable
+        self.frame_queue_size = rospy.get_param("~frame_queue_size", 2)
+        self.frame_policy = rospy.get_param("~frame_policy", "latest")  # what to drop when the queue is full
+        self.max_frame_age = rospy.get_param("~max_frame_age", 0.5)  # seconds, older frames are skipped
         print('before wait')
         msg = rospy.wait_for_message(info_topic, CameraInfo)
         print('after wait')
@@ -46,10 +60,24 @@ class UniformTSDFServer:
         xyz = center - np.r_[0.5 * length, 0.5 * length, 0.0]
         self.T_base_task = Transform.from_translation(xyz)
 
+    def init_pipeline(self):
+        # sensor_cb only converts the images, the tf lookup and integration run on a worker thread.
+        # The lock guards self.tsdf, which is also read by the cloud services.
+        self.frames = queue.Queue(maxsize=self.frame_queue_size)
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=100)
+        self.frame_ages = deque(maxlen=100)
+        self.dropped = {"queue_full": 0, "stale": 0, "tf_failure": 0, "reset": 0}
+        # Bumped by reset, frames carry the generation they were accepted in
+        self.generation = 0
+        threading.Thread(target=self.integration_worker, daemon=True).start()
+
     def init_topics(self):
         print('Init topic')
         self.scene_cloud_pub = rospy.Publisher("/tsdf_server/scene_cloud", PointCloud2, queue_size=1)
         self.map_cloud_pub = rospy.Publisher("map_cloud", PointCloud2, queue_size=1)
+        self.diagnostics_pub = rospy.Publisher("/diagnostics", DiagnosticArray, queue_size=1)
+        rospy.Timer(rospy.Duration(1.0), self.publish_metrics)
         rospy.Subscriber(self.depth_topic, Image, self.sensor_cb)
 
     def advertise_services(self):
@@ -59,7 +87,10 @@ class UniformTSDFServer:
         rospy.Service("get_map_cloud", vgn.srv.GetMapCloud, self.get_map_cloud)
 
     def reset(self, req):
-        self.tsdf = UniformTSDFVolume(self.length, self.resolution)
+        with self.lock:
+            self.tsdf = UniformTSDFVolume(self.length, self.resolution)
+            self.integration_count += 1
+            self.generation += 1
         return std_srvs.srv.EmptyResponse()
 
     def toggle(self, req):
@@ -68,35 +99,127 @@ class UniformTSDFServer:
 
     def sensor_cb(self, msg):
         # print('tsdf integration step -------------------')
+        # Frames are only accepted while integration is on. Once queued they are integrated even
+        # if integration is toggled off in the meantime, so the last frames of a view aren't lost
         if self.integrate:
             depth = (
                 self.cv_bridge.imgmsg_to_cv2(msg).astype(np.float32)
                 * self.depth_scaling
             )
-            extrinsic = tf.lookup(
-                self.cam_frame_id, self.base_frame_id, msg.header.stamp, rospy.Duration(0.1) # was 0.1
-            )
-            self.tsdf.integrate(depth, self.intrinsic, extrinsic * self.T_base_task)
+            self.enqueue_frame((self.generation, msg.header.stamp, depth))
 
-            # self.get_map_cloud(vgn.srv.GetMapCloud)
+    def enqueue_frame(self, frame):
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped["queue_full"] += 1
+            if self.frame_policy == "latest":
+                # Make room by dropping the oldest queued frame, the worker is the only other
+                # user of the queue and only ever removes frames
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    pass
+                self.frames.put_nowait(frame)
 
-    def get_scene_cloud(self, req):
+    def integration_worker(self):
+        while not rospy.is_shutdown():
+            try:
+                generation, stamp, depth = self.frames.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if generation != self.generation:
+                # Accepted before the last reset, doesn't belong in the new volume
+                self.dropped["reset"] += 1
+                continue
+            age = (rospy.Time.now() - stamp).to_sec()
+            if age > self.max_frame_age:
+                self.dropped["stale"] += 1
+                continue
+            start = time.time()
+            try:
+                extrinsic = tf.lookup(
+                    self.cam_frame_id, self.base_frame_id, stamp, rospy.Duration(0.1) # was 0.1
+                )
+            except Exception as e:
+                self.dropped["tf_failure"] += 1
+                rospy.logwarn_throttle(5.0, "TSDF server tf lookup failed: {}".format(e))
+                continue
+            with self.lock:
+                if generation != self.generation:
+                    self.dropped["reset"] += 1
+                    continue
+                self.tsdf.integrate(depth, self.intrinsic, extrinsic * self.T_base_task)
+                self.integration_count += 1
+            self.latencies.append(time.time() - start)
+            self.frame_ages.append(age)
+
+    def publish_metrics(self, event):
+        latencies = list(self.latencies) or [0.0]
+        ages = list(self.frame_ages) or [0.0]
+        values = {
+            "queue_depth": self.frames.qsize(),
+            "integrations": self.integration_count,
+            "integration_latency_mean_ms": 1e3 * np.mean(latencies),
+            "integration_latency_max_ms": 1e3 * np.max(latencies),
+            "frame_age_mean_ms": 1e3 * np.mean(ages),
+        }
+        values.update({"dropped_" + k: v for k, v in self.dropped.items()})
+        status = DiagnosticStatus(name="tsdf_server: integration", hardware_id="tsdf_server")
+        status.level = DiagnosticStatus.OK
+        status.message = "{} frames queued".format(values["queue_depth"])
+        status.values = [KeyValue(key=k, value=str(v)) for k, v in values.items()]
+        msg = DiagnosticArray(status=[status])
+        msg.header.stamp = rospy.Time.now()
+        self.diagnostics_pub.publish(msg)
+
+    def get_snapshot(self, name, extract):
+        # Reuses the last message while the map is unchanged, and also while it was extracted
+        # less than 1 / cloud_rate ago so that clients polling in a loop can't force extractions
+        now = time.time()
+        if name in self.snapshots:
+            count, extracted_at, msg = self.snapshots[name]
+            if count == self.integration_count or now - extracted_at < 1.0 / self.cloud_rate:
+                return msg, False
+        with self.lock:
+            count = self.integration_count
+            msg = extract()
+        msg.header.stamp = rospy.Time.now()  # lets clients skip snapshots they already have
+        self.snapshots[name] = (count, now, msg)
+        return msg, True
+
+    def extract_scene_cloud(self):
         scene_cloud = self.tsdf.get_scene_cloud()
         points = np.asarray(scene_cloud.points)
-        msg = to_cloud_msg(self.frame_id, points)
-        self.scene_cloud_pub.publish(msg)
+        return to_cloud_msg(self.frame_id, points)
+
+    def extract_map_cloud(self):
+        map_cloud = self.tsdf.get_map_cloud()
+        if self.map_cloud_decimation > 0.0:
+            # Averages the points and tsdf values that fall into the same coarser voxel
+            map_cloud = map_cloud.voxel_down_sample(self.map_cloud_decimation)
+        points = np.asarray(map_cloud.points)
+        distances = np.asarray(map_cloud.colors)[:, [0]]
+        return to_cloud_msg(self.frame_id, points, distances=distances)
+
+    def map_cloud_voxel_size(self):
+        # Spacing of the points in the map cloud, decimation never makes it finer than the tsdf
+        return max(self.map_cloud_decimation, self.tsdf.voxel_size)
+
+    def get_scene_cloud(self, req):
+        msg, fresh = self.get_snapshot("scene_cloud", self.extract_scene_cloud)
+        if fresh:
+            self.scene_cloud_pub.publish(msg)
         res = vgn.srv.GetSceneCloudResponse()
         res.scene_cloud = msg
         return res
 
     def get_map_cloud(self, req):
-        map_cloud = self.tsdf.get_map_cloud()
-        points = np.asarray(map_cloud.points)
-        distances = np.asarray(map_cloud.colors)[:, [0]]
-        msg = to_cloud_msg(self.frame_id, points, distances=distances)
-        self.map_cloud_pub.publish(msg)
+        msg, fresh = self.get_snapshot("map_cloud", self.extract_map_cloud)
+        if fresh:
+            self.map_cloud_pub.publish(msg)
         res = vgn.srv.GetMapCloudResponse()
-        res.voxel_size = self.tsdf.voxel_size
+        res.voxel_size = self.map_cloud_voxel_size()
         res.map_cloud = msg
         return res
 
@@ -1,3 +1,4 @@
+import argparse
 from pathlib import Path
 import os
 import rospkg
@@ -9,48 +10,23 @@ import open3d as o3d
 import matplotlib.pyplot as plt
 from tqdm import trange
 
-# Step 1: Data Preprocessing
-# def load_voxel_grids(file_paths):
-#     voxel_grids = []
-#     grid_size = (40, 40, 40)
-#     for file_path in file_paths:
-#         grid = np.zeros(grid_size)
-#         pcd = o3d.io.read_point_cloud(file_path)
-#         points = np.asarray(pcd.points).astype(int)
-#         grid[points[:, 0], points[:, 1], points[:, 2]] = 1
-#         # voxel_grid = o3d.geometry.VoxelGrid.create_from_point_cloud(pcd, voxel_size=0.0075)
-
-#         # Expand the voxel grid to have a single channel
-#         grid = grid[np.newaxis, :, :, :]
-#         voxel_grids.append(grid)
-#     return voxel_grids
-
-def load_voxel_grids(file_paths):
-    voxel_grids = []
-    grid_size = (40, 40, 40)
-    num_files = len(file_paths)
-    assert num_files % 2 == 0, "The number of file paths should be even."
-
-    for i in range(0, num_files, 2):
-        # Load the first point cloud and create the first voxel grid
-        grid1 = np.zeros(grid_size)
-        pcd1 = o3d.io.read_point_cloud(file_paths[i])
-        points1 = np.asarray(pcd1.points).astype(int)
-        grid1[points1[:, 0], points1[:, 1], points1[:, 2]] = 1
-        grid1 = grid1[np.newaxis, :, :, :]
-
-        # Load the second point cloud and create the second voxel grid
-        grid2 = np.zeros(grid_size)
-        pcd2 = o3d.io.read_point_cloud(file_paths[i + 1])
-        points2 = np.asarray(pcd2.points).astype(int)
-        grid2[points2[:, 0], points2[:, 1], points2[:, 2]] = 1
-        grid2 = grid2[np.newaxis, :, :, :]
-
-        # Concatenate the two voxel grids along the channel dimension (dim=0)
-        combined_grid = np.concatenate((grid1, grid2), axis=0)
-        voxel_grids.append(combined_grid)
+from active_search.dataset import INDEX_FILE, VoxelDatasetWriter, VoxelGridDataset
+from active_search.models import amp_dtype, join_channels
 
-    return voxel_grids
+# Step 1: Data Preprocessing
+def convert_pcd_dataset(directory_path, writer):
+    # One-off conversion of the old p{N}_occu.pcd / p{N}_tsdf.pcd pairs
+    voxel_size = 0.3 / writer.resolution
+    indices = sorted(int(f[1:-9]) for f in os.listdir(directory_path) if f.endswith("_occu.pcd"))
+    for n in indices:
+        occu = o3d.io.read_point_cloud(os.path.join(directory_path, "p{}_occu.pcd".format(n)))
+        tsdf = o3d.io.read_point_cloud(os.path.join(directory_path, "p{}_tsdf.pcd".format(n)))
+        points = np.asarray(tsdf.points)
+        distances = np.asarray(tsdf.colors)[:, 0]
+        grid = np.zeros((writer.resolution,) * 3, dtype=np.float32)
+        grid[tuple((points // voxel_size).astype(int).T)] = distances
+        writer.append(grid, np.asarray(occu.points).astype(int))
+    return len(indices)
 
 def split_combined_voxel_grids(combined_grids):
     assert len(combined_grids) % 2 == 0, "The number of combined voxel grids should be even."
@@ -105,51 +81,109 @@ class Autoencoder(nn.Module):
 
 # Step 3: Training
 # Training function
-def train_autoencoder(train_data, val_data, num_epochs, batch_size):
+def make_loader(dataset, batch_size, shuffle, num_workers):
+    # Samples are decoded from the memory mapped chunks inside the workers, the main
+    # process only receives ready batches in pinned memory
+    kwargs = {}
+    if num_workers > 0:
+        # torch < 2.0 rejects these without workers, even prefetch_factor=None
+        kwargs = dict(prefetch_factor=4, persistent_workers=True)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        **kwargs,
+    )
+
+def train_autoencoder(train_data, val_data, num_epochs, batch_size, num_workers=4, amp=False, checkpoint_path=None):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("Training on:", device)
-    autoencoder = Autoencoder().to(device)
+    # Conv3d kernels are faster on NDHWC tensors, especially under autocast
+    autoencoder = Autoencoder().to(device, memory_format=torch.channels_last_3d)
     # use binary cross entropy
     criterion = nn.MSELoss()
     optimizer = optim.Adam(autoencoder.parameters(), lr=0.001)
 
-    train_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True)
-    val_loader = torch.utils.data.DataLoader(val_data, batch_size=batch_size, shuffle=False)
+    # fp16 on the GPU needs loss scaling, bf16 on the CPU does not
+    dtype = amp_dtype(device)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp and dtype == torch.float16)
+
+    train_loader = make_loader(train_data, batch_size, True, num_workers)
+    val_loader = make_loader(val_data, batch_size, False, num_workers)
 
     train_losses = [] 
     val_losses = []    
-
-    t = trange(num_epochs)
+    start_epoch = 0
+
+    if checkpoint_path is not None and Path(checkpoint_path).exists():
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        autoencoder.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        train_losses, val_losses = checkpoint["train_losses"], checkpoint["val_losses"]
+        start_epoch = checkpoint["epoch"] + 1
+        print("Resuming from epoch", start_epoch)
+
+    t = trange(start_epoch, num_epochs)
     for epoch in t:
-        running_loss = 0.0
+        # Losses are accumulated on the device to avoid a sync after every batch
+        running_loss = torch.zeros((), device=device)
+        autoencoder.train()
         for batch in train_loader:  # Loop through batches in DataLoader
-            inputs = batch.to(device)
-            optimizer.zero_grad()
-            outputs = autoencoder(inputs)
-            loss = criterion(outputs, inputs)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item() * inputs.size(0)
-        epoch_loss = running_loss / len(train_loader.dataset)
+            inputs = to_inputs(batch, device)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device.type, dtype=dtype, enabled=amp):
+                outputs = autoencoder(inputs)
+            loss = criterion(outputs.float(), inputs)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            running_loss += loss.detach() * inputs.size(0)
+        epoch_loss = running_loss.item() / len(train_loader.dataset)
         train_losses.append(epoch_loss)
 
         # Validation
-        val_loss = 0.0
+        val_loss = torch.zeros((), device=device)
+        autoencoder.eval()
         with torch.no_grad():
             for batch in val_loader:  # Loop through batches in DataLoader
-                inputs = batch.to(device)
-                outputs = autoencoder(inputs)
-                loss = criterion(outputs, inputs)
-                val_loss += loss.item() * inputs.size(0)
-            val_loss /= len(val_loader.dataset)
+                inputs = to_inputs(batch, device)
+                with torch.autocast(device.type, dtype=dtype, enabled=amp):
+                    outputs = autoencoder(inputs)
+                loss = criterion(outputs.float(), inputs)
+                val_loss += loss * inputs.size(0)
+            val_loss = val_loss.item() / len(val_loader.dataset)
             val_losses.append(val_loss)
 
+        if checkpoint_path is not None:
+            save_checkpoint(checkpoint_path, {
+                "epoch": epoch,
+                "model": autoencoder.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
+                "train_losses": train_losses,
+                "val_losses": val_losses,
+            })
+
         t.set_description(f'Epoch {epoch + 1}/{num_epochs}, Train Loss: {epoch_loss:.4f}, Val Loss: {val_loss:.4f}')
     
     plot_autoencoder(train_losses, val_losses)
 
     return autoencoder
 
+def to_inputs(batch, device):
+    # Only the float16 tsdf and the packed occlusion bits cross the host-device boundary
+    tsdf, packed = (b.to(device, non_blocking=True) for b in batch)
+    return join_channels(tsdf, packed).contiguous(memory_format=torch.channels_last_3d)
+
+def save_checkpoint(path, checkpoint):
+    # Write to a temporary file first so an interrupted save never corrupts the last checkpoint
+    tmp_path = str(path) + ".tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
 def plot_autoencoder(train, val):
     epochs = range(1, len(train) + 1)
     plt.figure(figsize=(8, 6))
@@ -171,7 +205,7 @@ def plot_autoencoder(train, val):
 def encode_voxel_grids(autoencoder, new_voxel_grids):
     # new_voxel_grids = torch.tensor(new_voxel_grids.reshape(-1, 40*40*40), dtype=torch.float32)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    new_voxel_grids = new_voxel_grids.clone().detach().to(device)
+    new_voxel_grids = to_inputs(new_voxel_grids, device)
     encoded_voxel = autoencoder.encoder(new_voxel_grids)
     return encoded_voxel
 
@@ -180,50 +214,50 @@ def decode_voxel_grids(autoencoder, encoded_voxel):
     return decoded_voxel
 
 
-import os
-
-# Function to get file paths for all .pcd files in the specified directory
-def get_pcd_file_paths(directory_path):
-    file_paths = []
-    for filename in os.listdir(directory_path):
-        if filename.endswith(".pcd"):
-            file_path = os.path.join(directory_path, filename)
-            file_paths.append(file_path)
-    return file_paths
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--amp", action="store_true", help="bf16 autocast on cpu, fp16 on gpu")
+    parser.add_argument("--no-checkpoint", action="store_true")
+    parser.add_argument("--resolution", type=int, default=40, help="grid size of converted pcd data")
+    return parser
 
 def main():
+    args = create_parser().parse_args()
 
     rospack = rospkg.RosPack()
     pkg_root = Path(rospack.get_path("active_search"))
-    data_folder_path = str(pkg_root)+"/training/"
-    file_paths = get_pcd_file_paths(data_folder_path)  # List of file paths to your .pcd files
-    voxel_grids = load_voxel_grids(file_paths)
-
-    # Convert to PyTorch tensors and flatten the voxel grids
-    # voxel_tensors = torch.tensor(np.asarray(voxel_grids).reshape(-1, 40*40*40), dtype=torch.float32)
-    voxel_tensors = torch.tensor(np.asarray(voxel_grids), dtype=torch.float32)
-    print(voxel_tensors.shape)
-
-    num_data = int(voxel_tensors.shape[0]*0.8)
-    data = voxel_tensors[:num_data]
-    holdout_data = voxel_tensors[num_data:]
-
-    # Split into training and validation sets
-    num_train_samples = int(data.shape[0]*0.8)
-    train_data = data[:num_train_samples]
-    val_data = data[num_train_samples:]
-
-    # Define autoencoder parameters
-    num_epochs = 100
-    batch_size = 128
-
-    # Train the autoencoder
-    trained_autoencoder = train_autoencoder(train_data, val_data, num_epochs, batch_size)
+    data_folder_path = pkg_root / "training"
+    if not (data_folder_path / INDEX_FILE).exists():
+        num_converted = convert_pcd_dataset(data_folder_path, VoxelDatasetWriter(data_folder_path, args.resolution))
+        print("Converted", num_converted, "pcd pairs")
+
+    # Samples stay on disk and are only decoded when a batch is requested
+    dataset = VoxelGridDataset(data_folder_path)
+    print(len(dataset), "samples")
+
+    # 80% of the data for training and validation (split 80/20), the rest is held out
+    train_data, val_data, holdout_data = dataset.split(0.64, 0.16)
+
+    # Train the autoencoder, picking up from the last checkpoint if there is one
+    checkpoint_path = pkg_root / "models/autoencoder_checkpoint.pth"
+    trained_autoencoder = train_autoencoder(
+        train_data,
+        val_data,
+        args.epochs,
+        args.batch_size,
+        num_workers=args.workers,
+        amp=args.amp,
+        checkpoint_path=None if args.no_checkpoint else checkpoint_path,
+    )
 
     # Step 4: Evaluation (similar as before)
 
     # Step 5: Encoding and Decoding  
-    encoded_voxel = encode_voxel_grids(trained_autoencoder, holdout_data)
+    holdout_batch = next(iter(make_loader(holdout_data, args.batch_size, False, 0)))
+    encoded_voxel = encode_voxel_grids(trained_autoencoder, holdout_batch)
     decoded_voxel = decode_voxel_grids(trained_autoencoder, encoded_voxel)
 
     print(decoded_voxel.shape)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Times the shared perception kernels on a synthetic scene at different grid resolutions. The
+# scene is a sphere in the middle of a 30 cm workspace observed from above, the occluded voxels
+# are the ones on its far side.
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from active_grasp.bbox import AABBox
+from robot_helpers.spatial import Transform
+from vgn.utils import look_at
+
+from active_search.kernels import cast_rays, information_gain
+
+SIZE = 0.3
+
+
+def synthetic_scene(resolution):
+    voxel_size = SIZE / resolution
+    center = np.r_[0.15, 0.15, 0.1]
+    radius = 0.05
+    points = (np.indices((resolution,) * 3).reshape(3, -1).T + 0.5) * voxel_size
+    sdf = np.linalg.norm(points - center, axis=1) - radius
+    tsdf = np.clip(sdf / (4 * voxel_size), -1.0, 1.0)
+    tsdf_grid = ((tsdf + 1.0) / 2.0).reshape((resolution,) * 3).astype(np.float32)
+    occluded = np.argwhere(((sdf < 0) & (points[:, 2] < center[2])).reshape((resolution,) * 3))
+    bbox = AABBox(center - radius, center + radius)
+    return tsdf_grid, voxel_size, occluded, bbox
+
+
+def time_fn(fn, runs):
+    fn()  # compilation and warm-up
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = fn()
+    return (time.perf_counter() - start) / runs, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[40, 64, 80])
+    parser.add_argument("--downsample", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    intrinsic = SimpleNamespace(fx=540.0, fy=540.0, cx=320.0, cy=240.0)
+    view = look_at(np.r_[0.15, 0.15, 0.6], np.r_[0.15, 0.15, 0.1], np.r_[1.0, 0.0, 0.0])
+    T_task_base = Transform.identity()
+
+    print("{:>12}{:>14}{:>12}{:>12}{:>8}".format("resolution", "raycast ms", "voxels", "ig ms", "ig"))
+    for resolution in args.resolutions:
+        tsdf_grid, voxel_size, occluded, bbox = synthetic_scene(resolution)
+        fx, fy = intrinsic.fx / args.downsample, intrinsic.fy / args.downsample
+        cx, cy = intrinsic.cx / args.downsample, intrinsic.cy / args.downsample
+        ori, pos = view.rotation.as_matrix(), view.translation
+        ray_time, voxels = time_fn(
+            lambda: cast_rays(
+                voxel_size, -1.0 + 2.0 * tsdf_grid, ori, pos, fx, fy, cx, cy,
+                0, int(2 * cx), 0, int(2 * cy), 0.0, 0.6, np.sqrt(3) * voxel_size,
+            ),
+            args.runs,
+        )
+        ig_time, ig = time_fn(
+            lambda: information_gain(
+                tsdf_grid, voxel_size, intrinsic, view, bbox, T_task_base, occluded, args.downsample
+            ),
+            args.runs,
+        )
+        print(
+            "{:>12}{:>14.2f}{:>12}{:>12.2f}{:>8}".format(
+                resolution, 1e3 * ray_time, len(voxels), 1e3 * ig_time, ig
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Reports how the latency of every stage of the policy's perception pipeline scales with the
+# tsdf resolution, for either tsdf backend. A sphere lying on a table is rendered analytically from
+# a few views above the 30 cm workspace and pushed through integration, grid extraction, the
+# occlusion search, the information gain raycast and the encoder.
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from active_grasp.bbox import AABBox
+from robot_helpers.perception import CameraIntrinsic
+from robot_helpers.spatial import Transform
+from vgn.utils import look_at
+
+from active_search.dataset import occupancy_from_coordinates, pack_occupancy
+from active_search.dynamic_perception import create_tsdf_volume
+from active_search.kernels import information_gain
+from active_search.models import Autoencoder
+from active_search.search_policy import find_occluded_voxels
+
+LENGTH = 0.3
+CENTER = np.r_[0.15, 0.15, 0.05]
+RADIUS = 0.05
+
+
+def render_depth(intrinsic, view):
+    # Depth image of a sphere resting on the z = 0 plane, view is the camera pose in the task frame
+    u, v = np.meshgrid(np.arange(intrinsic.width), np.arange(intrinsic.height))
+    rays = np.stack([(u - intrinsic.cx) / intrinsic.fx, (v - intrinsic.cy) / intrinsic.fy, np.ones_like(u, dtype=float)], -1)
+    directions = rays @ view.rotation.as_matrix().T
+    origin = view.translation
+
+    depth = np.full(u.shape, np.inf)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_table = -origin[2] / directions[..., 2]
+    depth = np.where(t_table > 0, t_table, depth)
+
+    oc = origin - CENTER
+    b = directions @ oc
+    a = (directions**2).sum(-1)
+    disc = b**2 - a * (oc @ oc - RADIUS**2)
+    t_sphere = (-b - np.sqrt(np.clip(disc, 0, None))) / a
+    depth = np.where((disc > 0) & (t_sphere > 0), np.minimum(depth, t_sphere), depth)
+    depth[~np.isfinite(depth)] = 0.0
+    return depth.astype(np.float32)  # rays are not normalized, so t is the z depth
+
+
+def timed(timings, name, fn):
+    start = time.perf_counter()
+    result = fn()
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+    return result
+
+
+def run(backend, resolution, intrinsic, views, images, device, runs):
+    timings = {}
+    autoencoder = Autoencoder(resolution)
+    autoencoder.configure_inference(device)
+    for _ in range(runs):
+        tsdf = create_tsdf_volume(backend, LENGTH, resolution)
+        for view, img in zip(views, images):
+            timed(timings, "integrate", lambda: tsdf.integrate(img, intrinsic, view.inv()))
+        grid = timed(timings, "get_grid", lambda: tsdf.get_grid())
+
+        vol = timed(timings, "get_volume", lambda: tsdf.get_volume()[..., 0])
+        bb_size = np.full(3, 2 * RADIUS / tsdf.voxel_size).astype(int)
+        occ_mat = timed(timings, "occlusion", lambda: find_occluded_voxels(vol, bb_size, device.type))
+        occluded = np.argwhere(occ_mat > 0)
+
+        bbox = AABBox(CENTER - RADIUS, CENTER + RADIUS)
+        timed(
+            timings,
+            "information_gain",
+            lambda: [
+                information_gain(grid, tsdf.voxel_size, intrinsic, v, bbox, Transform.identity(), occluded, 10)
+                for v in views
+            ],
+        )
+
+        packed = pack_occupancy(occupancy_from_coordinates(occluded, resolution))
+        tsdf_tensor = torch.from_numpy(grid).to(device).unsqueeze(0)
+        occu_tensor = torch.from_numpy(packed).to(device).view(1, -1)
+        timed(timings, "encode", lambda: autoencoder.encode_packed(tsdf_tensor, occu_tensor))
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    return {name: 1e3 * t / runs for name, t in timings.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[40, 64, 80])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend", choices=["uniform", "hashed"], default="uniform")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    intrinsic = CameraIntrinsic(640, 480, 540.0, 540.0, 320.0, 240.0)
+    eyes = [np.r_[0.15, 0.15, 0.55], np.r_[0.35, 0.15, 0.5], np.r_[0.15, -0.05, 0.5]]
+    views = [look_at(eye, CENTER, np.r_[1.0, 0.0, 0.0]) for eye in eyes]
+    images = [render_depth(intrinsic, view) for view in views]
+
+    # The first pass compiles the numba kernels and initializes the cuda context
+    run(args.backend, args.resolutions[0], intrinsic, views, images, device, 1)
+
+    stages = ["integrate", "get_grid", "get_volume", "occlusion", "information_gain", "encode"]
+    print("{:>12}".format("resolution") + "".join("{:>18}".format(s + " ms") for s in stages))
+    for resolution in args.resolutions:
+        timings = run(args.backend, resolution, intrinsic, views, images, device, args.runs)
+        print("{:>12}".format(resolution) + "".join("{:>18.2f}".format(timings[s]) for s in stages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Measures how long the policy modules take to import and how long numba needs to compile the
+# raycast kernels with and without the on-disk cache. Every measurement runs in a fresh
+# interpreter so that nothing is shared with previous imports.
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+MODULES = [
+    "active_search",
+    "active_search.search_policy",
+    "active_search.active_search",
+    "active_search.kernels",
+    "active_search.rl_controller",
+]
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+COMPILE_SNIPPET = """
+import time
+import numpy as np
+start = time.perf_counter()
+from active_search.kernels import raycast
+raycast(1.0, np.zeros((40, 40, 40), dtype=np.float32), np.eye(3), np.zeros(3), 1.0, 1.0, 1.0, 1.0, 0, 1, 0, 1, 0.0, 1.0, 0.1)
+print(time.perf_counter() - start)
+"""
+
+
+def run(snippet):
+    output = subprocess.run(
+        [sys.executable, "-c", snippet], check=True, capture_output=True, text=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def clear_numba_cache():
+    import active_search
+
+    for cache_dir in Path(active_search.__file__).parent.glob("**/__pycache__"):
+        for f in list(cache_dir.glob("*.nbi")) + list(cache_dir.glob("*.nbc")):
+            f.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:<32}{:>12}".format("import", "time s"))
+    for module in MODULES:
+        times = [run(IMPORT_SNIPPET.format(module=module)) for _ in range(args.runs)]
+        print("{:<32}{:>12.3f}".format(module, min(times)))
+
+    clear_numba_cache()
+    cold = run(COMPILE_SNIPPET)
+    warm = min(run(COMPILE_SNIPPET) for _ in range(args.runs))
+    print("raycast first call, no cache:   {:.3f} s".format(cold))
+    print("raycast first call, with cache: {:.3f} s".format(warm))
+
+
+if __name__ == "__main__":
+    main()
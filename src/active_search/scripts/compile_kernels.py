@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+# Builds the ahead-of-time compiled version of active_search.kernels. The resulting extension
+# is placed next to kernels.py and imported instead of compiling the kernels with numba at
+# runtime. It has to be rebuilt whenever the kernels change.
+#
+# Note: numba.pycc is deprecated upstream, the on-disk jit cache works without this step.
+
+import argparse
+from pathlib import Path
+
+from numba.pycc import CC
+
+import active_search
+from active_search import kernels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", type=Path, default=Path(active_search.__file__).parent)
+    args = parser.parse_args()
+
+    cc = CC("_kernels_aot")
+    cc.output_dir = str(args.output_dir)
+    for dtype in kernels.GRID_DTYPES:
+        cc.export("raycast_" + dtype, kernels.RAYCAST_SIGNATURE.format(dtype))(kernels._raycast)
+    cc.compile()
+    print("Compiled kernels to", args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ import threading
 import open3d as o3d
 import cv2
 import rospkg
-import os
 import torch
 import time
 from queue import Queue
@@ -15,13 +14,15 @@ from active_search.bullet_utils import *
 from robot_helpers.model import *
 from robot_helpers.spatial import Transform
 from active_search.search_sim import Simulation
-from active_search.dynamic_perception import SceneTSDFVolume
+from active_search.dynamic_perception import SceneTSDFVolume, configured_resolution
+from active_search.dataset import VoxelDatasetWriter
 # from vgn.perception import UniformTSDFVolume
 from vgn.detection import VGN, select_local_maxima, to_voxel_coordinates
 
 class Environment:
-    def __init__(self, gui, scene_id, vgn_path):
+    def __init__(self, gui, scene_id, vgn_path, resolution=40):
         self.gui = gui
+        self.resolution = resolution
         self.scene_id = scene_id
         self.vgn_path = vgn_path
 
@@ -33,29 +34,16 @@ class Environment:
         self.sim.reset()
         self.scene_origin = Transform.from_translation(self.sim.scene.alt_origin)
         self.sim_state = Queue(maxsize=1)
-        # self.tsdf = SceneTSDFVolume(self.sim.scene.length, 40)
         self.init_tsdf()
         self.reset_tsdf = False
         self.save_scene = False
 
     def init_tsdf(self):
-        self.tsdf = SceneTSDFVolume(self.sim.scene.length, 40)
-        rospack = rospkg.RosPack()
-        pkg_root = Path(rospack.get_path("active_search"))
-        directory_path =  str(pkg_root)+"/training_test/"
-        files = os.listdir(directory_path)
-        matching_files = [file for file in files if file.startswith("p")]
-
-        if matching_files:
-            def extract_number(filename):
-                return int(filename[1:-9])  # Extract the numeric part, excluding the 'p' prefix and '.pcd' extension
-
-            sorted_files = sorted(matching_files, key=extract_number, reverse=True)
-            latest_file = sorted_files[0]
-            print("Latest file:", latest_file)
-            self.point_index = extract_number(latest_file) + 1
-        else:
-            self.point_index = 0
+        self.tsdf = SceneTSDFVolume(self.sim.scene.length, self.resolution)
+        if not hasattr(self, "dataset_writer"):
+            rospack = rospkg.RosPack()
+            pkg_root = Path(rospack.get_path("active_search"))
+            self.dataset_writer = VoxelDatasetWriter(pkg_root / "training_test", self.tsdf.resolution)
 
     def get_tsdf(self):
         cam_data = self.sim.camera.get_image()
@@ -69,20 +57,8 @@ class Environment:
             print(object_bb.index(rand_bb))
             self.sim.scene.remove_object(self.sim.scene.object_uids[object_bb.index(rand_bb)])
             object_bb.remove(rand_bb)
-            min_bound = np.floor(np.asarray(rand_bb.min_bound) / self.tsdf.voxel_size) - [4,4,4]
-            min_bound = np.clip(min_bound,0,np.inf).astype(int)
-            max_bound = np.ceil(np.asarray(rand_bb.max_bound) / self.tsdf.voxel_size) + [4,4,4]
-            max_bound = np.clip(max_bound,0,np.inf).astype(int)
+            min_bound, max_bound = self.tsdf.clear_region(rand_bb, padding=4 * self.tsdf.voxel_size)
             print(min_bound, max_bound)
-            tsdf_vec = np.asarray(self.tsdf.o3dvol.extract_volume_tsdf())
-            print(tsdf_vec)
-            tsdf_grid = np.reshape(tsdf_vec, [40,40,40,2])
-            print(tsdf_grid)
-            tsdf_grid[min_bound[0]:max_bound[0], min_bound[1]:max_bound[1], min_bound[2]:max_bound[2]] = 0
-            tsdf_vec = o3d.utility.Vector2dVector(np.reshape(tsdf_grid, [40*40*40,2]))
-            # self.tsdf.o3dvol.inject_volume_tsdf(tsdf_vec)
-            self.tsdf = SceneTSDFVolume(self.sim.scene.length, 40)
-            self.tsdf.o3dvol.inject_volume_tsdf(tsdf_vec)
             self.remove_rand_obj = False
         else:
             self.tsdf.integrate(depth_img, self.sim.camera.intrinsic, (self.sim.camera.pose.inv()*self.scene_origin).as_matrix()) 
@@ -93,21 +69,8 @@ class Environment:
     
 
     def save_tsdfs(self):
-
-        rospack = rospkg.RosPack()
-        pkg_root = Path(rospack.get_path("active_search"))
-        file_dir_occ = str(pkg_root)+"/training_test/p"+str(self.point_index)+"_occu.pcd"
-        file_dir_tsdf = str(pkg_root)+"/training_test/p"+str(self.point_index)+"_tsdf.pcd"
-        print(file_dir_occ)
-        print(file_dir_tsdf)
-        coord_o3d = o3d.utility.Vector3dVector(self.coordinate_mat)
-        poi_mat_o3d = o3d.geometry.PointCloud(points = coord_o3d)
-        write_occ = o3d.io.write_point_cloud(file_dir_occ, poi_mat_o3d, write_ascii=False, compressed=False, print_progress=False)
-        write_tsdf = o3d.io.write_point_cloud(file_dir_tsdf, self.tsdf.get_map_cloud(), write_ascii=False, compressed=False, print_progress=False)
-        print(write_occ, write_tsdf)
-        #only increment if we have created a set
-        if write_occ and write_tsdf:
-            self.point_index += 1
+        sample = self.dataset_writer.append(self.tsdf.get_grid(), self.coordinate_mat)
+        print("stored sample", sample)
 
     
     def get_target(self):
@@ -136,10 +99,7 @@ class Environment:
         resolution = self.tsdf.resolution
         voxel_size = self.tsdf.voxel_size
 
-        volume = self.tsdf.o3dvol.extract_volume_tsdf()
-        vol_array = np.asarray(volume)
-
-        vol_mat = vol_array[:,0].reshape(resolution, resolution, resolution)
+        vol_mat = np.ascontiguousarray(self.tsdf.get_volume()[..., 0])
 
         #bb_voxel = np.floor(self.target_bb.get_extent()/voxel_size)
         bb_voxel = [5,5,5]
@@ -363,8 +323,9 @@ def main():
     scene_id = "random"
     # scene_id = "as_test_scene.yaml"
     vgn_path = "src/vgn/assets/models/vgn_conv.pth" #was changed 
+    resolution = configured_resolution()
 
-    env = Environment(gui, scene_id, vgn_path)
+    env = Environment(gui, scene_id, vgn_path, resolution)
     env.load_engine()
     # env.init_ik_solver()
     env.get_target()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Exports the autoencoder's encoder and the grasp/view Q heads into a single frozen TorchScript
+# module. Point the nbv_grasp/exported_model param at the output to evaluate the policy with it,
+# online training (GraspController.run) needs the full networks.
+
+import argparse
+import time
+import torch
+
+from active_search.models import (
+    Autoencoder,
+    GraspEval,
+    ViewEval,
+    PolicyNetwork,
+    exported_policy_path,
+    load_policy_network,
+)
+
+
+def load_eager_network(resolution):
+    autoencoder = Autoencoder(resolution)
+    autoencoder.load_state_dict(torch.load(autoencoder.model_path, map_location="cpu"))
+    grasp_nn = GraspEval()
+    grasp_nn.load_state_dict(torch.load(grasp_nn.model_path, map_location="cpu"))
+    view_nn = ViewEval()
+    view_nn.load_state_dict(torch.load(view_nn.model_path, map_location="cpu"))
+    return PolicyNetwork(autoencoder.encoder, grasp_nn, view_nn).eval()
+
+
+def export(net, path):
+    scripted = torch.jit.script(net)
+    # Freezing inlines the weights as constants and folds them into the graph
+    frozen = torch.jit.freeze(scripted, preserved_attrs=["grasp_values", "view_values"])
+    frozen = torch.jit.optimize_for_inference(frozen, other_methods=["grasp_values", "view_values"])
+    torch.jit.save(frozen, path)
+
+
+def example_inputs(resolution=40, num_actions=16):
+    tsdf = torch.rand(1, resolution, resolution, resolution)
+    packed = torch.randint(0, 256, (1, (resolution**3 + 7) // 8), dtype=torch.uint8)
+    q = torch.rand(1, 7)
+    actions = torch.rand(num_actions, 7)
+    return tsdf, packed, q, actions
+
+
+def measure(net, inputs, runs):
+    tsdf, packed, q, actions = inputs
+    with torch.no_grad():
+        state = net(tsdf, packed, q)
+        start = time.perf_counter()
+        for _ in range(runs):
+            state = net(tsdf, packed, q)
+            action_input = torch.cat((state.repeat(len(actions), 1), actions), -1)
+            grasp_vals = net.grasp_values(action_input)
+            view_vals = net.view_values(action_input)
+        return (time.perf_counter() - start) / runs, state, grasp_vals, view_vals
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default=exported_policy_path())
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--resolution", type=int, default=40)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    net = load_eager_network(args.resolution)
+    export(net, args.output)
+    print("Exported policy network to", args.output)
+
+    start = time.perf_counter()
+    exported = load_policy_network(args.output, torch.device("cpu"))
+    load_time = time.perf_counter() - start
+
+    inputs = example_inputs(args.resolution)
+    eager_time, eager_state, eager_grasp, eager_view = measure(net, inputs, args.runs)
+    exported_time, state, grasp_vals, view_vals = measure(exported, inputs, args.runs)
+
+    print("Load time: {:.3f} s".format(load_time))
+    print("Eager step: {:.2f} ms, exported step: {:.2f} ms".format(1e3 * eager_time, 1e3 * exported_time))
+    print("Max state deviation:", (state - eager_state).abs().max().item())
+    print("Max grasp value deviation:", (grasp_vals - eager_grasp).abs().max().item())
+    print("Max view value deviation:", (view_vals - eager_view).abs().max().item())
+
+
+if __name__ == "__main__":
+    main()
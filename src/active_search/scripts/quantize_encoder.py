@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Calibrates an int8 version of the autoencoder's encoder on recorded TSDFs and reports how much
+# accuracy is traded for latency. Point the nbv_grasp/quantized_encoder param at the output to
+# use it in the policy on cpu-only hosts.
+
+import argparse
+import csv
+import io
+import time
+from pathlib import Path
+
+import rospkg
+import torch
+import torch.nn.functional as F
+
+from active_search.dataset import VoxelGridDataset
+from active_search.models import Autoencoder, join_channels, quantize_encoder, quantized_encoder_path
+
+
+def load_batches(dataset, batch_size, num_batches):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    batches = []
+    for tsdf, packed in loader:
+        batches.append(join_channels(tsdf, packed))
+        if len(batches) == num_batches:
+            break
+    return batches
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def latency(model, x, runs):
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(runs):
+            model(x)
+    return (time.perf_counter() - start) / runs
+
+
+def evaluate(name, model, reference, batches, runs):
+    with torch.no_grad():
+        embeddings = torch.cat([model(x) for x in batches])
+    error = (embeddings - reference).norm(dim=1) / reference.norm(dim=1).clamp(min=1e-6)
+    cosine = F.cosine_similarity(embeddings, reference, dim=1)
+    return {
+        "model": name,
+        "latency_ms": 1e3 * latency(model, batches[0][:1], runs),
+        "size_mb": model_size(model) / 1e6,
+        "rel_error": error.mean().item(),
+        "cosine_sim": cosine.mean().item(),
+        "min_cosine_sim": cosine.min().item(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calibration-batches", type=int, default=16)
+    parser.add_argument("--eval-batches", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", type=str, default=quantized_encoder_path())
+    parser.add_argument("--report", type=Path, default=None)
+    args = parser.parse_args()
+
+    pkg_root = Path(rospkg.RosPack().get_path("active_search"))
+
+    dataset = VoxelGridDataset(pkg_root / "training")
+
+    autoencoder = Autoencoder(dataset.reader.resolution)
+    autoencoder.load_state_dict(torch.load(autoencoder.model_path, map_location="cpu"))
+    encoder = autoencoder.encoder.eval()
+
+    # Calibrate and evaluate on disjoint parts of the recorded data
+    calibration_data, eval_data = dataset.split(0.5)
+    calibration = load_batches(calibration_data, args.batch_size, args.calibration_batches)
+    batches = load_batches(eval_data, args.batch_size, args.eval_batches)
+
+    with torch.no_grad():
+        reference = torch.cat([encoder(x) for x in batches])
+
+    dynamic = quantize_encoder(encoder, calibration, static=False)
+    full = quantize_encoder(encoder, calibration, static=True)
+
+    report = [
+        evaluate("fp32", encoder, reference, batches, args.runs),
+        evaluate("int8 dynamic linear", dynamic, reference, batches, args.runs),
+        evaluate("int8 static conv + dynamic linear", full, reference, batches, args.runs),
+    ]
+
+    print("{:<36}{:>12}{:>10}{:>12}{:>12}{:>12}".format("model", "latency ms", "size MB", "rel error", "cosine", "min cosine"))
+    for row in report:
+        print("{model:<36}{latency_ms:>12.2f}{size_mb:>10.1f}{rel_error:>12.4f}{cosine_sim:>12.4f}{min_cosine_sim:>12.4f}".format(**row))
+
+    if args.report is not None:
+        with open(args.report, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(report[0].keys()))
+            writer.writeheader()
+            writer.writerows(report)
+
+    scripted = torch.jit.trace(full, batches[0][:1])
+    torch.jit.save(scripted, args.output)
+    print("Saved int8 encoder to", args.output)
+
+
+if __name__ == "__main__":
+    main()
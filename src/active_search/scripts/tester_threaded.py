@@ -14,7 +14,7 @@ from active_search.bullet_utils import *
 from robot_helpers.model import *
 from robot_helpers.spatial import Transform
 from active_search.search_sim import Simulation
-from active_search.dynamic_perception import SceneTSDFVolume
+from active_search.dynamic_perception import SceneTSDFVolume, configured_resolution
 from vgn.detection import VGN, select_local_maxima, to_voxel_coordinates
 
 class Environment:
@@ -28,13 +28,14 @@ class Environment:
         self.sim.reset()
         self.scene_origin = Transform.from_translation(self.sim.scene.alt_origin)
         self.sim_state = Queue(maxsize=1)
-        self.tsdf = SceneTSDFVolume(self.sim.scene.length, 40)
+        self.resolution = configured_resolution()
+        self.tsdf = SceneTSDFVolume(self.sim.scene.length, self.resolution)
         self.reset_tsdf = False
 
     def get_tsdf(self):
             
         if self.reset_tsdf:
-            self.tsdf = SceneTSDFVolume(self.sim.scene.length, 40)
+            self.tsdf = SceneTSDFVolume(self.sim.scene.length, self.resolution)
         
         cam_data = self.sim.camera.get_image()
         image = cam_data[0]
@@ -94,10 +95,7 @@ class Environment:
         resolution = self.tsdf.resolution
         voxel_size = self.tsdf.voxel_size
 
-        volume = self.tsdf.o3dvol.extract_volume_tsdf()
-        vol_array = np.asarray(volume)
-
-        vol_mat = vol_array[:,0].reshape(resolution, resolution, resolution)
+        vol_mat = np.ascontiguousarray(self.tsdf.get_volume()[..., 0])
 
         #bb_voxel = np.floor(self.target_bb.get_extent()/voxel_size)
         bb_voxel = [5,5,5]
@@ -280,16 +278,8 @@ class Environment:
                     print(object_bb.index(rand_bb))
                     self.sim.scene.remove_object(self.sim.scene.object_uids[object_bb.index(rand_bb)])
                     object_bb.remove(rand_bb)
-                    min_bound = np.floor(np.asarray(rand_bb.min_bound) / self.tsdf.voxel_size).astype(int)
-                    max_bound = np.ceil(np.asarray(rand_bb.max_bound) / self.tsdf.voxel_size).astype(int)
-                    # tsdf_grid = tsdf.get_grid()
+                    min_bound, max_bound = tsdf.clear_region(rand_bb)
                     print(min_bound, max_bound)
-                    tsdf_vec = np.asarray(tsdf.o3dvol.extract_volume_tsdf())
-                    tsdf_grid = np.reshape(tsdf_vec, [40,40,40,2])
-                    print(tsdf_grid.shape)
-                    tsdf_grid[min_bound[0]:max_bound[0], min_bound[1]:max_bound[1], min_bound[2]:max_bound[2]] = 0
-                    tsdf_vec = o3d.utility.Vector2dVector(np.reshape(tsdf_grid, [40*40*40,2]))
-                    tsdf = tsdf.o3dvol.inject_volume_tsdf(tsdf_vec)
                     self.remove_rand_obj = False
                 else:
                     state = self.sim_state.get()
@@ -1,9 +1,8 @@
 from .search_policy import register
-from active_grasp.baselines import *
-from .active_search import NextBestView
 
-register("initial-view", InitialView)
-register("top-view", TopView)
-register("top-trajectory", TopTrajectory)
-register("fixed-trajectory", FixedTrajectory)
-register("nbv", NextBestView)
\ No newline at end of file
+# Policies are registered by name and imported on first use, see search_policy.make
+register("initial-view", "active_grasp.baselines:InitialView")
+register("top-view", "active_grasp.baselines:TopView")
+register("top-trajectory", "active_grasp.baselines:TopTrajectory")
+register("fixed-trajectory", "active_grasp.baselines:FixedTrajectory")
+register("nbv", "active_search.active_search:NextBestView")
\ No newline at end of file
@@ -1,79 +1,75 @@
-import itertools
-from numba import jit
-import numpy as np
-import torch
-import torch.nn.functional as F
-import open3d as o3d
+import os
 import rospy
+import threading
 import time
 
 from active_search.search_policy import MultiViewPolicy
-from active_grasp.timer import Timer
-from .models import Autoencoder, GraspEval, ViewEval
 # from .ppo import * 
 
-
-@jit(nopython=True)
-def get_voxel_at(voxel_size, p):
-    index = (p / voxel_size).astype(np.int64)
-    return index if (index >= 0).all() and (index < 40).all() else None
-
-
-# Note that the jit compilation takes some time the first time raycast is called
-@jit(nopython=True)
-def raycast(
-    voxel_size,
-    tsdf_grid,
-    ori,
-    pos,
-    fx,
-    fy,
-    cx,
-    cy,
-    u_min,
-    u_max,
-    v_min,
-    v_max,
-    t_min,
-    t_max,
-    t_step,
-):
-    voxel_indices = []
-    for u in range(u_min, u_max):
-        for v in range(v_min, v_max):
-            direction = np.asarray([(u - cx) / fx, (v - cy) / fy, 1.0])
-            direction = ori @ (direction / np.linalg.norm(direction))
-            t, tsdf_prev = t_min, -1.0
-            while t < t_max:
-                p = pos + t * direction
-                t += t_step
-                index = get_voxel_at(voxel_size, p)
-                if index is not None:
-                    i, j, k = index
-                    tsdf = tsdf_grid[i, j, k]
-                    if tsdf * tsdf_prev < 0 and tsdf_prev > -1:  # crossed a surface
-                        break
-                    voxel_indices.append(index)
-                    tsdf_prev = tsdf
-    return voxel_indices
+# torch, the networks and the numba kernels are imported by the warm-up thread, see
+# NextBestView.warm_up
 
 
 class NextBestView(MultiViewPolicy):
     def __init__(self):
+        # Load the networks and compile the raycaster while the base class waits on ROS. The
+        # resolution is needed by the warm-up and reused by Policy.load_parameters
+        self.resolution = rospy.get_param("policy/resolution", 40)
+        self.ready = threading.Event()
+        self.warm_up_error = None
+        threading.Thread(target=self.warm_up, daemon=True).start()
         super().__init__()
         self.min_z_dist = rospy.get_param("~camera/min_z_dist")
         self.max_views = rospy.get_param("nbv_grasp/max_views")
         self.min_gain = rospy.get_param("nbv_grasp/min_gain")
         self.downsample = rospy.get_param("nbv_grasp/downsample")
-        self.load_models()
-        self.compile()
 
+    def warm_up(self):
+        try:
+            start = time.time()
+            self.load_models()
+            self.compile()
+            rospy.loginfo("Policy warm-up took {:.2f} s".format(time.time() - start))
+        except Exception as e:
+            self.warm_up_error = e
+        finally:
+            self.ready.set()
+
+    def wait_until_ready(self):
+        self.ready.wait()
+        if self.warm_up_error is not None:
+            raise RuntimeError("Policy warm-up failed") from self.warm_up_error
 
     def load_models(self):
+        import torch
+        from .models import Autoencoder, GraspEval, ViewEval, load_policy_network
+
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.autoencoder = Autoencoder()
+
+        # Inference only runtime exported by scripts/export_policy.py, it has no decoder and
+        # can't be trained online
+        exported_path = rospy.get_param("nbv_grasp/exported_model", "")
+        if exported_path and os.path.exists(exported_path):
+            self.policy_net = load_policy_network(exported_path, self.device)
+            self.autoencoder = None
+            self.grasp_nn = self.policy_net.grasp_values
+            self.view_nn = self.policy_net.view_values
+            return
+
+        self.policy_net = None
+        self.autoencoder = Autoencoder(self.resolution)
         self.autoencoder.load_state_dict(torch.load(self.autoencoder.model_path))
-        self.autoencoder.to(self.device).float()
+        self.autoencoder.configure_inference(
+            self.device,
+            amp=rospy.get_param("nbv_grasp/amp", False),
+            channels_last=rospy.get_param("nbv_grasp/channels_last", True),
+        )
+
+        # int8 encoder calibrated by scripts/quantize_encoder.py, only used on cpu hosts
+        quantized_path = rospy.get_param("nbv_grasp/quantized_encoder", "")
+        if quantized_path and os.path.exists(quantized_path) and self.device.type == "cpu":
+            self.autoencoder.encoder = torch.jit.load(quantized_path, map_location="cpu")
+            self.autoencoder.amp = False
 
         self.grasp_nn = GraspEval()
         self.grasp_nn.load_model()
@@ -83,44 +79,47 @@ class NextBestView(MultiViewPolicy):
         self.view_nn.load_model()
         self.view_nn.to(self.device).float()
 
+    def require_trainable(self):
+        # The exported runtime only has the forward passes of the value heads, see load_models
+        self.wait_until_ready()
+        if self.policy_net is not None:
+            raise RuntimeError(
+                "nbv_grasp/exported_model is inference only, unset it to train the policy online"
+            )
+
     def compile(self):
-        # Trigger the JIT compilation
-        raycast(
-            1.0,
-            np.zeros((40, 40, 40), dtype=np.float32),
-            np.eye(3),
-            np.zeros(3),
-            1.0,
-            1.0,
-            1.0,
-            1.0,
-            0,
-            1,
-            0,
-            1,
-            0.0,
-            1.0,
-            0.1,
-        )
+        # Compiles the kernels, or loads them from numba's on-disk cache on warm starts
+        from .kernels import warm_up
+
+        warm_up()
 
     def activate(self, bbox, view_sphere):
+        self.wait_until_ready()
         super().activate(bbox, view_sphere)
 
     def get_encoded_state(self, img, x, q):
+        import torch
+
+        self.wait_until_ready()
         self.integrate(img, x, q)
         #Encode the scene using our trained autoencoder
         # start = time.time()
-        map_cloud = self.tsdf.get_map_cloud()
-        occu_vec = o3d.utility.Vector3dVector(self.coordinate_mat)
-        occu = o3d.geometry.PointCloud(points = occu_vec)
-        cloud = self.join_clouds(map_cloud, occu)
-        cloud_tensor = torch.tensor(np.asarray(cloud), dtype=torch.float32).to(self.device)
-        encoded_voxel = self.autoencoder.encoder(cloud_tensor.view(1,2,40,40,40)) #need to view as a simgle sample
+        tsdf_grid, packed_occu = self.join_clouds(self.coordinate_mat)
+        # The occlusion grid is transferred bit-packed and expanded on the device
+        tsdf_tensor = torch.tensor(tsdf_grid, device=self.device).unsqueeze(0) #need to view as a simgle sample
+        occu_tensor = torch.from_numpy(packed_occu).to(self.device).view(1,-1)
+        q_tensor = torch.tensor([q]).to(self.device)
+        if self.policy_net is not None:
+            with torch.no_grad():
+                return self.policy_net(tsdf_tensor, occu_tensor, q_tensor)
+        encoded_voxel = self.autoencoder.encode_packed(tsdf_tensor, occu_tensor)
         # print("Encode Time:", time.time()- start)
-        state = torch.cat((encoded_voxel, torch.tensor([q]).to(self.device)), 1)
+        state = torch.cat((encoded_voxel, q_tensor), 1)
         return state
     
     def get_actions(self, state, q):
+        import torch
+
         self.get_grasps(q)
 
         self.views = self.generate_views(q)
@@ -142,17 +141,21 @@ class NextBestView(MultiViewPolicy):
 
 
     def update(self, grasp_input, view_input):
+        import torch
 
         print("grasp shape", grasp_input.shape)
         print("viwe shape", view_input.shape)
 
-        grasp_vals = self.grasp_nn(grasp_input) if grasp_input.shape[0] > 0 else torch.empty((0)).to(self.device)
-        view_vals = self.view_nn(view_input) if view_input.shape[0] > 0 else torch.empty((0)).to(self.device)
+        with torch.set_grad_enabled(self.policy_net is None):
+            grasp_vals = self.grasp_nn(grasp_input) if grasp_input.shape[0] > 0 else torch.empty((0)).to(self.device)
+            view_vals = self.view_nn(view_input) if view_input.shape[0] > 0 else torch.empty((0)).to(self.device)
 
         return grasp_vals, view_vals
     
     
     def sample_action(self, grasp_input, view_input, grasp_vals, view_vals):
+        import torch
+        import torch.nn.functional as F
 
         if self.done:
             grasp = True
@@ -196,6 +199,8 @@ class NextBestView(MultiViewPolicy):
         return [grasp, view, selected_action, value, action_input.view(1, -1), self.done]
 
     def get_best_action(self, grasp_input, view_input, grasp_vals, view_vals):
+        import torch
+
         if self.done:
             grasp = True
             view = False
@@ -229,118 +234,16 @@ class NextBestView(MultiViewPolicy):
         return [grasp, view, selected_action, value, action_input.view(1, -1), self.done]
 
 
-    def join_clouds(self, map_cloud, occu):
-        grid_size = (40, 40, 40)
-        grid1 = np.zeros(grid_size)
-        points1 = np.asarray(map_cloud.points)
-        distances = np.asarray(map_cloud.colors)[:, [0]]
-
-        grid1 = np.zeros((40, 40, 40), dtype=np.float32)
-        indices = (points1 // self.tsdf.voxel_size).astype(int)
-        grid1[tuple(indices.T)] = distances.squeeze()
-        # grid1[points1[:, 0], points1[:, 1], points1[:, 2]] = 1
-        grid1 = grid1[np.newaxis, :, :, :]
-        
-        # Grid 2 is the occluded voxel locations
-        grid2 = np.zeros(grid_size)
-        points2 = np.asarray(occu.points).astype(int)
-        grid2[points2[:, 0], points2[:, 1], points2[:, 2]] = 1
-        grid2 = grid2[np.newaxis, :, :, :]
-
-        # Concatenate the two voxel grids along the channel dimension (dim=0)
-        combined_grid = np.concatenate((grid1, grid2), axis=0)
-
-        return combined_grid
-
-    def best_grasp_prediction_is_stable(self):
-        if self.best_grasp:
-            t = (self.T_task_base * self.best_grasp.pose).translation
-            i, j, k = (t / self.tsdf.voxel_size).astype(int)
-            qs = self.qual_hist[:, i, j, k]
-            if np.count_nonzero(qs) == self.T and np.mean(qs) > 0.9:
-                return True
-        return False
-
-    def generate_views(self, q):
-        thetas = np.deg2rad([15, 30])
-        phis = np.arange(8) * np.deg2rad(45)
-        view_candidates = []
-        for theta, phi in itertools.product(thetas, phis):
-            view = self.view_sphere.get_view(theta, phi)
-            if self.solve_cam_ik(q, view):
-                view_candidates.append(view)
-        print("generating",len(view_candidates),"views")
-        return view_candidates
-
-    def ig_fn(self, view, downsample):
-        tsdf_grid, voxel_size = self.tsdf.get_grid(), self.tsdf.voxel_size
-        tsdf_grid = -1.0 + 2.0 * tsdf_grid  # Open3D maps tsdf to [0,1]
-
-        # Downsample the sensor resolution
-        fx = self.intrinsic.fx / downsample
-        fy = self.intrinsic.fy / downsample
-        cx = self.intrinsic.cx / downsample
-        cy = self.intrinsic.cy / downsample
-
-        # Project bbox onto the image plane to get better bounds
-        T_cam_base = view.inv()
-        corners = np.array([T_cam_base.apply(p) for p in self.bbox.corners]).T
-        u = (fx * corners[0] / corners[2] + cx).round().astype(int)
-        v = (fy * corners[1] / corners[2] + cy).round().astype(int)
-        u_min, u_max = u.min(), u.max()
-        v_min, v_max = v.min(), v.max()
-
-        t_min = 0.0  # self.min_z_dist
-        t_max = corners[2].max()  # This bound might be a bit too short
-        t_step = np.sqrt(3) * voxel_size  # Could be replaced with line rasterization
-
-        # Cast rays from the camera view (we'll work in the task frame from now on)
-        view = self.T_task_base * view
-        ori, pos = view.rotation.as_matrix(), view.translation
-
-        voxel_indices = raycast(
-            voxel_size,
-            tsdf_grid,
-            ori,
-            pos,
-            fx,
-            fy,
-            cx,
-            cy,
-            u_min,
-            u_max,
-            v_min,
-            v_max,
-            t_min,
-            t_max,
-            t_step,
-        )
-
-        # Count rear side voxels within the bounding box
-        # indices_list = np.unique(voxel_indices, axis=0)
-        # print(indices_list)
-        indices = set(map(tuple, voxel_indices)) 
-        # print(indices)
-        indices = indices.intersection(self.coord_set)
-        indices_list = list(indices)
-        
-        bbox_min = self.T_task_base.apply(self.bbox.min) / voxel_size
-        bbox_max = self.T_task_base.apply(self.bbox.max) / voxel_size
-        mask = np.array([((i > bbox_min) & (i < bbox_max)).all() for i in indices_list], dtype = int)
-        # i, j, k = indices_list[mask].T
-        # i, j, k = zip(*indices_list[mask])
-        if len(indices_list) == 0:
-            return 0
-        try:
-            i, j, k = zip(*[tpl for i, tpl in enumerate(indices_list) if mask[i]])
-        except:
-            return 0
+    def join_clouds(self, coordinates):
+        from .dataset import occupancy_from_coordinates, pack_occupancy
 
+        # Shared with the rest of the step through the tsdf's cache, so it is read-only
+        grid1 = self.tsdf.get_grid()
 
-        tsdfs = tsdf_grid[i, j, k]
-        ig = np.logical_and(tsdfs > -1.0, tsdfs < 0.0).sum()
+        # Grid 2 is the occluded voxel locations, packed to one bit per voxel
+        grid2 = pack_occupancy(occupancy_from_coordinates(coordinates, self.tsdf.resolution))
 
-        return ig
+        return grid1, grid2
 
     def cost_fn(self, view):
         return 1.0
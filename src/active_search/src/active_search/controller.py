@@ -18,7 +18,8 @@ from robot_helpers.ros.panda import PandaArmClient, PandaGripperClient
 from robot_helpers.ros.moveit import MoveItClient, create_collision_object_from_mesh
 from robot_helpers.spatial import Rotation, Transform
 from vgn.utils import look_at, cartesian_to_spherical, spherical_to_cartesian
-from vgn.detection import select_local_maxima
+
+from active_search.detection import first_grasp_in_bbox
 
 
 class GraspController:
@@ -91,13 +92,13 @@ class GraspController:
         bbs = self.reset()
         self.complete = False
         # bbox = bbs.pop(-1)
-        voxel_size = 0.0075
+        length = self.policy.tsdf.length
         x_off = 0.35
         y_off = -0.15
         z_off = 0.2
 
         bb_min = [x_off,y_off,z_off]
-        bb_max = [40*voxel_size+x_off,40*voxel_size+y_off,40*voxel_size+z_off]
+        bb_max = [length+x_off,length+y_off,length+z_off]
         self.bbox = AABBox(bb_min, bb_max)
         self.switch_to_cartesian_velocity_control()
         # grasps = []
@@ -195,26 +196,15 @@ class GraspController:
         self.policy.activate(bbox, self.view_sphere)
         origin = self.policy.T_base_task
         origin.translation[2] -= 0.05
-        voxel_size, tsdf_grid = self.policy.tsdf.voxel_size, self.policy.tsdf.get_grid()
+        voxel_size = self.policy.tsdf.voxel_size
         # Then check whether VGN can find any grasps on the target
-        out = self.policy.vgn.predict(tsdf_grid)
-        grasps, qualities = select_local_maxima(voxel_size, out, threshold=0.8)
-
-        for grasp in grasps:
-            pose = origin * grasp.pose
-            tip = pose.rotation.apply([0, 0, 0.05]) + pose.translation
-            if bbox.is_inside(tip):
-                return True, grasp
-        return False, None
+        out = self.policy.predict_grasps()
+        grasp = first_grasp_in_bbox(voxel_size, out, origin, bbox, threshold=0.8)
+        return grasp is not None, grasp
     
     def grasp_ig(self, grasp):
-        #naive estimation of information gain from the grasping of an opject
-        t = (self.policy.T_task_base * grasp.pose).translation
-        i, j, k = (t / self.policy.tsdf.voxel_size).astype(int)
-        bb_voxel = [5,5,5] #place holder for the actual target object size 
-        # grasp_ig_mat = self.policy.occ_mat[i:i+2*bb_voxel[0],j-(bb_voxel[1]//2):j+(bb_voxel[1]//2),:] #most "correct approach" but gives some issues
-        grasp_ig_mat = self.policy.occ_mat[i:,j-(bb_voxel[1]//2):j+(bb_voxel[1]//2),:] #most "correct approach" but gives some issues
-        grasp_ig = grasp_ig_mat.sum()
+        # Upper bound on the occlusion reduction from removing the grasped object, see lookahead
+        grasp_ig = self.policy.grasp_removal_gain_bounds([grasp])[0]
         print("Grasp information gain:", grasp_ig)
         return grasp_ig
 
@@ -357,5 +347,8 @@ class ViewHalfSphere:
         up = np.r_[1.0, 0.0, 0.0]
         return look_at(eye, self.center, up)
 
-    def sample_view(self):
-        raise NotImplementedError
+    def sample_view(self, max_theta=np.pi / 4, rng=np.random):
+        # Uniform over the cap of the sphere within max_theta of the top
+        theta = np.arccos(1.0 - rng.uniform() * (1.0 - np.cos(max_theta)))
+        phi = rng.uniform(0.0, 2.0 * np.pi)
+        return self.get_view(theta, phi)
@@ -0,0 +1,180 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+# On-disk layout of a voxel dataset directory:
+#   index.json        resolution, chunk size and number of stored samples
+#   tsdf_00000.npy    (chunk_size, R, R, R) float16 tsdf distances
+#   occu_00000.npy    (chunk_size, ceil(R^3 / 8)) uint8 bit-packed occlusion grid
+# Chunks are plain .npy files so they can be memory-mapped without copying.
+
+INDEX_FILE = "index.json"
+
+
+def packed_size(resolution):
+    return (resolution**3 + 7) // 8
+
+
+def occupancy_from_coordinates(coordinates, resolution):
+    grid = np.zeros((resolution,) * 3, dtype=bool)
+    coordinates = np.asarray(coordinates, dtype=int).reshape(-1, 3)
+    if len(coordinates) > 0:
+        grid[tuple(coordinates.T)] = True
+    return grid
+
+
+def pack_occupancy(grid):
+    return np.packbits(np.asarray(grid, dtype=bool).ravel())
+
+
+class VoxelDatasetWriter:
+    """Appends (tsdf grid, occlusion grid) samples to a chunked dataset directory."""
+
+    def __init__(self, root, resolution=40, chunk_size=256):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        index_path = self.root / INDEX_FILE
+        if index_path.exists():
+            self.index = json.loads(index_path.read_text())
+            if self.index["resolution"] != resolution:
+                raise ValueError(
+                    "{} stores {}^3 grids, got resolution {}".format(
+                        self.root, self.index["resolution"], resolution
+                    )
+                )
+        else:
+            self.index = {"resolution": resolution, "chunk_size": chunk_size, "count": 0}
+        self.resolution = self.index["resolution"]
+        self.chunk_size = self.index["chunk_size"]
+        self._chunk_id = None
+
+    def __len__(self):
+        return self.index["count"]
+
+    def append(self, tsdf_grid, occupancy):
+        """Store one sample.
+
+        occupancy is either a dense (R, R, R) grid or an (N, 3) array of occluded voxel indices.
+        """
+        occupancy = np.asarray(occupancy)
+        if occupancy.shape != (self.resolution,) * 3:
+            occupancy = occupancy_from_coordinates(occupancy, self.resolution)
+
+        chunk_id, slot = divmod(self.index["count"], self.chunk_size)
+        self._open_chunk(chunk_id, create=slot == 0)
+        self._tsdf[slot] = np.asarray(tsdf_grid).reshape((self.resolution,) * 3)
+        self._occu[slot] = pack_occupancy(occupancy)
+        self._tsdf.flush()
+        self._occu.flush()
+
+        self.index["count"] += 1
+        self._write_index()
+        return self.index["count"] - 1
+
+    def _open_chunk(self, chunk_id, create):
+        if chunk_id == self._chunk_id and not create:
+            return
+        tsdf_path, occu_path = chunk_paths(self.root, chunk_id)
+        if create or not tsdf_path.exists():
+            self._tsdf = np.lib.format.open_memmap(
+                tsdf_path, mode="w+", dtype=np.float16,
+                shape=(self.chunk_size,) + (self.resolution,) * 3,
+            )
+            self._occu = np.lib.format.open_memmap(
+                occu_path, mode="w+", dtype=np.uint8,
+                shape=(self.chunk_size, packed_size(self.resolution)),
+            )
+        else:
+            self._tsdf = np.load(tsdf_path, mmap_mode="r+")
+            self._occu = np.load(occu_path, mmap_mode="r+")
+        self._chunk_id = chunk_id
+
+    def _write_index(self):
+        # Write then rename so that readers never see a half written index
+        tmp_path = self.root / (INDEX_FILE + ".tmp")
+        tmp_path.write_text(json.dumps(self.index))
+        os.replace(tmp_path, self.root / INDEX_FILE)
+
+
+class VoxelDatasetReader:
+    """Zero-copy access to a dataset written by VoxelDatasetWriter."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index = json.loads((self.root / INDEX_FILE).read_text())
+        self.resolution = self.index["resolution"]
+        self.chunk_size = self.index["chunk_size"]
+        self._chunks = {}
+
+    def __len__(self):
+        return self.index["count"]
+
+    def chunk(self, chunk_id):
+        if chunk_id not in self._chunks:
+            tsdf_path, occu_path = chunk_paths(self.root, chunk_id)
+            self._chunks[chunk_id] = (
+                np.load(tsdf_path, mmap_mode="r"),
+                np.load(occu_path, mmap_mode="r"),
+            )
+        return self._chunks[chunk_id]
+
+    def __getitem__(self, i):
+        """Returns memory-mapped views of the float16 tsdf grid and the packed occlusion bits."""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        chunk_id, slot = divmod(i, self.chunk_size)
+        tsdf, occu = self.chunk(chunk_id)
+        return tsdf[slot], occu[slot]
+
+
+class VoxelGridDataset(torch.utils.data.Dataset):
+    """Torch view of a voxel dataset returning (float16 tsdf, packed occlusion) samples.
+
+    The memory maps are opened lazily so that every DataLoader worker maps the chunks itself
+    instead of receiving a pickled copy of the data.
+    """
+
+    def __init__(self, root, indices=None):
+        self.root = Path(root)
+        index = json.loads((self.root / INDEX_FILE).read_text())
+        self.indices = np.arange(index["count"]) if indices is None else np.asarray(indices)
+        self._reader = None
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = VoxelDatasetReader(self.root)
+        return self._reader
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        # The occlusion channel is kept bit-packed, it is expanded on the training device
+        tsdf, occu = self.reader[int(self.indices[i])]
+        return torch.from_numpy(np.array(tsdf)), torch.from_numpy(np.array(occu))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_reader"] = None
+        return state
+
+    def split(self, *fractions):
+        """Splits the samples in order, e.g. split(0.64, 0.16) returns three datasets."""
+        bounds = np.cumsum([0.0] + list(fractions)) * len(self)
+        bounds = list(bounds.astype(int)) + [len(self)]
+        return [
+            VoxelGridDataset(self.root, self.indices[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+
+def chunk_paths(root, chunk_id):
+    root = Path(root)
+    return root / "tsdf_{:05d}.npy".format(chunk_id), root / "occu_{:05d}.npy".format(chunk_id)
@@ -0,0 +1,95 @@
+from pathlib import Path
+import threading
+
+import numpy as np
+from scipy import ndimage
+
+from robot_helpers.spatial import Rotation, Transform
+from vgn.grasp import Grasp
+
+# Vectorized grasp post-processing. select_candidates does the same non-max suppression as
+# vgn.detection.select_local_maxima but keeps the candidates as arrays, so transforming them and
+# testing their tips against a bbox is a handful of array ops instead of a python loop over Grasp
+# objects. Grasps are only built for the candidates that survive the filtering.
+
+# Networks loaded through shared_model, keyed by (resolved path, loader). Entries also store the
+# checkpoint's mtime so an updated file is picked up on the next request.
+_models = {}
+_models_lock = threading.Lock()
+
+
+def shared_model(path, load):
+    """Returns load(path), reusing the instance from earlier calls while the file is unchanged."""
+    path = Path(path).resolve()
+    mtime = path.stat().st_mtime_ns
+    key = (path, load)
+    with _models_lock:
+        entry = _models.get(key)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, load(path))
+            _models[key] = entry
+        return entry[1]
+
+
+def load_vgn(path):
+    from vgn.detection import VGN
+
+    return shared_model(path, VGN)
+
+
+class GraspCandidates:
+    def __init__(self, rotations, positions, widths, qualities):
+        self.rotations = rotations  # (N, 3, 3)
+        self.positions = positions  # (N, 3)
+        self.widths = widths
+        self.qualities = qualities
+
+    def __len__(self):
+        return len(self.qualities)
+
+    def transform(self, T):
+        """Returns the candidates expressed in the frame T maps to, e.g. T_base_task."""
+        R, t = T.rotation.as_matrix(), T.translation
+        return GraspCandidates(
+            R @ self.rotations, self.positions @ R.T + t, self.widths, self.qualities
+        )
+
+    def tips(self, offset=0.05):
+        # Point offset along the approach (z) axis of each gripper
+        return self.positions + offset * self.rotations[:, :, 2]
+
+    def tips_inside(self, bbox, offset=0.05):
+        tips = self.tips(offset)
+        return ((tips > bbox.min) & (tips < bbox.max)).all(axis=1)
+
+    def grasp(self, n):
+        pose = Transform(Rotation.from_matrix(self.rotations[n]), self.positions[n])
+        return Grasp(pose, self.widths[n])
+
+
+def select_candidates(voxel_size, out, threshold=0.9, max_filter_size=3):
+    """Local maxima of out.qual above threshold, with positions and widths in meters."""
+    qual = out.qual
+    maxima = ndimage.maximum_filter(qual, size=max_filter_size)
+    indices = np.argwhere((qual == maxima) & (qual > threshold))
+    i, j, k = indices.T
+    if len(indices) > 0:
+        rotations = Rotation.from_quat(out.rot[:, i, j, k].T).as_matrix()
+    else:
+        rotations = np.empty((0, 3, 3))
+    return GraspCandidates(
+        rotations,
+        indices * voxel_size,
+        out.width[i, j, k] * voxel_size,
+        qual[i, j, k],
+    )
+
+
+def first_grasp_in_bbox(voxel_size, out, T, bbox, threshold=0.8):
+    """Returns the first candidate whose tip, transformed by T, lies inside bbox, or None."""
+    candidates = select_candidates(voxel_size, out, threshold)
+    inside = candidates.transform(T).tips_inside(bbox)
+    if inside.any():
+        return candidates.grasp(np.argmax(inside))
+    return None
+
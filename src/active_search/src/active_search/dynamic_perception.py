@@ -1,12 +1,82 @@
 import numpy as np
 import open3d as o3d
 
-from vgn.utils import map_cloud_to_grid
 from robot_helpers import perception
 
 
-class SceneTSDFVolume:
-    def __init__(self, length, resolution):
+def region_bounds(aabb):
+    # Accepts both AABBox and open3d's AxisAlignedBoundingBox
+    if hasattr(aabb, "min_bound"):
+        return np.asarray(aabb.min_bound), np.asarray(aabb.max_bound)
+    return np.asarray(aabb.min), np.asarray(aabb.max)
+
+
+def region_indices(aabb, voxel_size, resolution, padding=0.0):
+    # Voxel index bounds [lo, hi) covering the box grown by padding, clipped to the grid
+    bb_min, bb_max = region_bounds(aabb)
+    lo = np.floor((bb_min - padding) / voxel_size)
+    hi = np.ceil((bb_max + padding) / voxel_size)
+    return np.clip(lo, 0, resolution).astype(int), np.clip(hi, 0, resolution).astype(int)
+
+
+def map_cloud_to_grid(voxel_size, resolution, points, distances):
+    grid = np.zeros((resolution,) * 3, dtype=np.float32)
+    indices = (points // voxel_size).astype(int)
+    grid[tuple(indices.T)] = distances.squeeze()
+    return grid
+
+
+def read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+class VersionedVolume:
+    """Memoizes the conversions of a tsdf volume until it is next modified.
+
+    version is bumped by integrate and clear_region. The cached arrays are shared between all
+    callers and are therefore returned read-only, copy them before modifying.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._cache = {}
+
+    def invalidate(self):
+        self.version += 1
+        self._cache.clear()
+
+    def cached(self, key, fn):
+        if key in self._cache:
+            return self._cache[key]
+        version = self.version
+        value = fn()
+        # Don't keep a result that was computed while another thread modified the volume
+        if version == self.version:
+            self._cache[key] = value
+        return value
+
+    def get_map_points(self):
+        # Voxel centers and normalized tsdf values of the map cloud
+        def extract():
+            map_cloud = self.get_map_cloud()
+            points = read_only(np.asarray(map_cloud.points))
+            distances = read_only(np.asarray(map_cloud.colors)[:, 0])
+            return points, distances
+
+        return self.cached("map_points", extract)
+
+    def get_grid(self):
+        def extract():
+            points, distances = self.get_map_points()
+            return read_only(map_cloud_to_grid(self.voxel_size, self.resolution, points, distances))
+
+        return self.cached("grid", extract)
+
+
+class SceneTSDFVolume(VersionedVolume):
+    def __init__(self, length=0.3, resolution=40):
+        super().__init__()
         self.length = length
         self.resolution = resolution
         self.voxel_size = self.length / self.resolution
@@ -34,21 +104,166 @@ class SceneTSDFVolume:
             convert_rgb_to_intensity=False,
         )
         intrinsic_o3d = intrinsic.to_o3d()
+        if hasattr(extrinsic, "as_matrix"):
+            extrinsic = extrinsic.as_matrix()
         self.o3dvol.integrate(rgbd, intrinsic_o3d, extrinsic)
+        self.invalidate()
+
+    def get_scene_cloud(self):
+        return self.cached("scene_cloud", self.o3dvol.extract_point_cloud)
+
+    def get_map_cloud(self):
+        return self.cached("map_cloud", self.o3dvol.extract_voxel_point_cloud)
+
+    def get_volume(self):
+        # (R, R, R, 2) array with the normalized tsdf and the weight of every voxel
+        def extract():
+            volume = np.asarray(self.o3dvol.extract_volume_tsdf())
+            return read_only(volume.reshape((self.resolution,) * 3 + (2,)))
 
+        return self.cached("volume", extract)
 
+    def clear_region(self, aabb, padding=0.0):
+        """Resets the voxels inside aabb to unobserved and returns their index bounds [lo, hi).
+
+        The legacy volume only exposes the whole voxel array, so it is copied out and written
+        back into the same volume rather than into a newly allocated one.
+        """
+        lo, hi = region_indices(aabb, self.voxel_size, self.resolution, padding)
+        region = (slice(lo[0], hi[0]), slice(lo[1], hi[1]), slice(lo[2], hi[2]))
+        grid = self._cache.get("grid")
+        volume = self.get_volume().copy()
+        volume[region] = 0
+        self.o3dvol.inject_volume_tsdf(o3d.utility.Vector2dVector(volume.reshape(-1, 2)))
+        self.invalidate()
+        # Only the region changed, so the dense arrays are patched instead of extracted again.
+        # Unobserved voxels aren't part of the map cloud and read as 0 in the grid
+        self._cache["volume"] = read_only(volume)
+        if grid is not None:
+            grid = grid.copy()
+            grid[region] = 0
+            self._cache["grid"] = read_only(grid)
+        return lo, hi
+
+
+class HashedTSDFVolume(VersionedVolume):
+    """Voxel hashed tsdf that only allocates blocks of voxels around observed surfaces.
+
+    The map itself is unbounded, get_grid, get_map_cloud and get_volume return the dense
+    resolution^3 window starting at window_origin so the policy sees the same data as with
+    SceneTSDFVolume.
+    """
+
+    def __init__(self, length=0.3, resolution=40, block_resolution=8, block_count=10000, device="CPU:0", depth_max=2.0):
+        super().__init__()
+        self.length = length
+        self.resolution = resolution
+        self.voxel_size = self.length / self.resolution
+        self.sdf_trunc = 4 * self.voxel_size
+        self.depth_max = depth_max
+        self.window_origin = np.zeros(3)
+        self.device = o3d.core.Device(device)
+        self.vbg = o3d.t.geometry.VoxelBlockGrid(
+            attr_names=("tsdf", "weight"),
+            attr_dtypes=(o3d.core.float32, o3d.core.float32),
+            attr_channels=((1), (1)),
+            voxel_size=self.voxel_size,
+            block_resolution=block_resolution,
+            block_count=block_count,
+            device=self.device,
+        )
+
+    def integrate(self, depth_img, intrinsic, extrinsic):
+        if hasattr(extrinsic, "as_matrix"):
+            extrinsic = extrinsic.as_matrix()
+        depth = o3d.t.geometry.Image(o3d.core.Tensor(np.ascontiguousarray(depth_img, dtype=np.float32)))
+        depth = depth.to(self.device)
+        K = np.array([[intrinsic.fx, 0.0, intrinsic.cx], [0.0, intrinsic.fy, intrinsic.cy], [0.0, 0.0, 1.0]])
+        K = o3d.core.Tensor(K, o3d.core.float64)
+        extrinsic = o3d.core.Tensor(np.asarray(extrinsic), o3d.core.float64)
+        # Only the blocks touched by the truncation band of the new frame are allocated
+        block_coords = self.vbg.compute_unique_block_coordinates(
+            depth, K, extrinsic, depth_scale=1.0, depth_max=self.depth_max, trunc_voxel_multiplier=4.0
+        )
+        self.vbg.integrate(
+            block_coords, depth, K, extrinsic, depth_scale=1.0, depth_max=self.depth_max, trunc_voxel_multiplier=4.0
+        )
+        self.invalidate()
 
     def get_scene_cloud(self):
-        return self.o3dvol.extract_point_cloud()
+        def extract():
+            cloud = self.vbg.extract_point_cloud().to_legacy()
+            return cloud.translate(-self.window_origin)
+
+        return self.cached("scene_cloud", extract)
+
+    def get_volume(self, window_origin=None):
+        # Dense (R, R, R, 2) tsdf and weight window, in the layout of extract_volume_tsdf
+        if window_origin is None:
+            return self.cached("volume", lambda: read_only(self.extract_window(self.window_origin)))
+        return self.extract_window(np.asarray(window_origin))
+
+    def extract_window(self, window_origin):
+        volume = np.zeros((self.resolution,) * 3 + (2,), dtype=np.float32)
+        buf_indices = self.vbg.hashmap().active_buf_indices()
+        if buf_indices.shape[0] == 0:
+            return volume
+        coords, flat_indices = self.vbg.voxel_coordinates_and_flattened_indices(buf_indices)
+        index = np.floor((coords.cpu().numpy() - window_origin) / self.voxel_size + 0.5).astype(int)
+        inside = ((index >= 0) & (index < self.resolution)).all(axis=1)
+        flat_indices = flat_indices.cpu().numpy()[inside]
+        index = tuple(index[inside].T)
+        volume[index + (0,)] = self.vbg.attribute("tsdf").reshape((-1,)).cpu().numpy()[flat_indices]
+        volume[index + (1,)] = self.vbg.attribute("weight").reshape((-1,)).cpu().numpy()[flat_indices]
+        return volume
+
+    def clear_region(self, aabb, padding=0.0):
+        """Resets the allocated voxels inside aabb to unobserved, see SceneTSDFVolume.clear_region."""
+        lo, hi = region_indices(aabb, self.voxel_size, self.resolution, padding)
+        buf_indices = self.vbg.hashmap().active_buf_indices()
+        if buf_indices.shape[0] == 0:
+            return lo, hi
+        coords, flat_indices = self.vbg.voxel_coordinates_and_flattened_indices(buf_indices)
+        index = np.floor((coords.cpu().numpy() - self.window_origin) / self.voxel_size + 0.5).astype(int)
+        inside = ((index >= lo) & (index < hi)).all(axis=1)
+        selected = flat_indices[o3d.core.Tensor(np.flatnonzero(inside).astype(np.int64), device=self.device)]
+        # The attribute tensors are views of the hash map values, so this writes the map in place
+        for name in ("tsdf", "weight"):
+            self.vbg.attribute(name).reshape((-1,))[selected] = 0.0
+        self.invalidate()
+        return lo, hi
 
     def get_map_cloud(self):
-        return self.o3dvol.extract_voxel_point_cloud()
+        return self.cached("map_cloud", self.extract_map_cloud)
 
-    def get_grid(self):
-        map_cloud = self.get_map_cloud()
-        points = np.asarray(map_cloud.points)
-        distances = np.asarray(map_cloud.colors)[:, [0]]
-        return map_cloud_to_grid(self.voxel_size, points, distances)
+    def extract_map_cloud(self):
+        # Same selection and encoding as UniformTSDFVolume.extract_voxel_point_cloud
+        volume = self.get_volume()
+        tsdf, weight = volume[..., 0], volume[..., 1]
+        index = np.argwhere((weight != 0) & (tsdf < 0.98) & (tsdf >= -0.98))
+        distances = (tsdf[tuple(index.T)] + 1.0) / 2.0
+        map_cloud = o3d.geometry.PointCloud()
+        map_cloud.points = o3d.utility.Vector3dVector((index + 0.5) * self.voxel_size)
+        map_cloud.colors = o3d.utility.Vector3dVector(np.repeat(distances[:, None], 3, axis=1))
+        return map_cloud
+
+
+def configured_resolution(default=40):
+    # policy/resolution for the simulation scripts, which also run without a ROS master
+    import rosgraph
+    import rospy
+
+    if rosgraph.is_master_online():
+        return rospy.get_param("policy/resolution", default)
+    return default
+
+
+def create_tsdf_volume(backend="uniform", length=0.3, resolution=40):
+    if backend == "uniform":
+        return SceneTSDFVolume(length, resolution)
+    elif backend == "hashed":
+        return HashedTSDFVolume(length, resolution)
+    raise ValueError("Unknown tsdf backend {}".format(backend))
 
 
 def create_tsdf(size, resolution, imgs, intrinsic, views):
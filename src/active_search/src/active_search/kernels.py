@@ -0,0 +1,349 @@
+import itertools
+from numba import jit
+import numpy as np
+
+# Perception kernels shared by the nbv policies. Nothing in here assumes a grid size, the
+# resolution is always taken from the grid that is passed in.
+#
+# The numba kernels are compiled for explicit signatures when this module is imported and
+# cached on disk (cache=True), so only the very first import after an
+# install or a change to this file pays for the compilation. Running scripts/compile_kernels.py
+# additionally builds an ahead-of-time compiled extension that is picked up here when present
+# and needs no numba compilation at all.
+
+GRID_DTYPES = ("float32", "float64")
+
+RAYCAST_SIGNATURE = (
+    "int64[:, ::1](float64, {}[:, :, :], float64[:, ::1], float64[::1], float64, float64, float64,"
+    " float64, int64, int64, int64, int64, float64, float64, float64)"
+)
+RAYCAST_SIGNATURES = [RAYCAST_SIGNATURE.format(dtype) for dtype in GRID_DTYPES]
+
+
+@jit(nopython=True, cache=True)
+def get_voxel_at(voxel_size, p, resolution):
+    index = (p / voxel_size).astype(np.int64)
+    return index if (index >= 0).all() and (index < resolution).all() else None
+
+
+def _raycast(
+    voxel_size,
+    tsdf_grid,
+    ori,
+    pos,
+    fx,
+    fy,
+    cx,
+    cy,
+    u_min,
+    u_max,
+    v_min,
+    v_max,
+    t_min,
+    t_max,
+    t_step,
+):
+    resolution = tsdf_grid.shape[0]
+    voxel_indices = []
+    for u in range(u_min, u_max):
+        for v in range(v_min, v_max):
+            direction = np.asarray([(u - cx) / fx, (v - cy) / fy, 1.0])
+            direction = ori @ (direction / np.linalg.norm(direction))
+            t, tsdf_prev = t_min, -1.0
+            while t < t_max:
+                p = pos + t * direction
+                t += t_step
+                index = get_voxel_at(voxel_size, p, resolution)
+                if index is not None:
+                    i, j, k = index
+                    tsdf = tsdf_grid[i, j, k]
+                    if tsdf * tsdf_prev < 0 and tsdf_prev > -1:  # crossed a surface
+                        break
+                    voxel_indices.append(index)
+                    tsdf_prev = tsdf
+    # Returned as an (N, 3) array so the result type is fixed for the signatures above
+    result = np.empty((len(voxel_indices), 3), dtype=np.int64)
+    for n in range(len(voxel_indices)):
+        result[n] = voxel_indices[n]
+    return result
+
+
+try:
+    from . import _kernels_aot
+except ImportError:
+    _kernels_aot = None
+
+if _kernels_aot is None:
+    raycast = jit(RAYCAST_SIGNATURES, nopython=True, cache=True)(_raycast)
+else:
+
+    def raycast(voxel_size, tsdf_grid, *args):
+        # The extension exports one function per signature
+        if tsdf_grid.dtype == np.float32:
+            return _kernels_aot.raycast_float32(voxel_size, tsdf_grid, *args)
+        return _kernels_aot.raycast_float64(voxel_size, tsdf_grid, *args)
+
+
+def cast_rays(voxel_size, tsdf_grid, ori, pos, fx, fy, cx, cy, u_min, u_max, v_min, v_max, t_min, t_max, t_step):
+    """Converts the arguments to the compiled signature before calling raycast."""
+    return raycast(
+        float(voxel_size),
+        tsdf_grid if tsdf_grid.dtype in (np.float32, np.float64) else tsdf_grid.astype(np.float32),
+        np.ascontiguousarray(ori, dtype=np.float64),
+        np.ascontiguousarray(pos, dtype=np.float64),
+        float(fx),
+        float(fy),
+        float(cx),
+        float(cy),
+        int(u_min),
+        int(u_max),
+        int(v_min),
+        int(v_max),
+        float(t_min),
+        float(t_max),
+        float(t_step),
+    )
+
+
+def warm_up():
+    """Calls each compiled kernel once on tiny inputs, so that compiling them or loading them from
+    numba's cache happens now rather than in the first policy step."""
+    get_voxel_at(1.0, np.zeros(3), 2)
+    for dtype in GRID_DTYPES:
+        grid = np.zeros((2, 2, 2), dtype=dtype)
+        cast_rays(1.0, grid, np.eye(3), np.zeros(3), 1.0, 1.0, 0.0, 0.0, 0, 1, 0, 1, 0.0, 1.0, 0.5)
+
+
+def generate_views(view_sphere, q, solve_cam_ik, thetas=(15, 30), num_phis=8, return_configs=False):
+    """Returns the views on the sphere around the target that the camera can reach from q.
+
+    With return_configs the ik solutions of the views are returned as well.
+    """
+    phis = np.arange(num_phis) * 2.0 * np.pi / num_phis
+    views = [view_sphere.get_view(theta, phi) for theta, phi in itertools.product(np.deg2rad(thetas), phis)]
+    view_candidates, configs = reachable_views(views, q, solve_cam_ik)
+    if return_configs:
+        return view_candidates, configs
+    return view_candidates
+
+
+def adaptive_views(
+    view_sphere,
+    q,
+    solve_cam_ik,
+    score_fn,
+    frontier=None,
+    thetas=(15, 30),
+    num_phis=8,
+    num_frontier=8,
+    num_random=4,
+    num_refine=4,
+    samples_per_view=3,
+    rng=np.random,
+):
+    """Coarse-to-fine view sampling on the view sphere.
+
+    The coarse set is the generate_views grid, plus views at the azimuths of num_frontier
+    randomly picked frontier points (in the base frame) and num_random views drawn uniformly from
+    the sphere cap. The coarse views are ranked with frontier_visibility, which needs no raycasts,
+    and the num_refine best ones are perturbed by up to half the grid spacing. Only those and their
+    perturbations are scored with score_fn, which maps a list of views to their gains, so it sees
+    at most num_refine * (1 + samples_per_view) views. Returns the scored views, their ik solutions
+    and their scores.
+    """
+    thetas = np.deg2rad(thetas)
+    theta_min, theta_max = thetas.min(), thetas.max()
+    angles = [(theta, phi) for theta, phi in itertools.product(thetas, np.arange(num_phis) * 2.0 * np.pi / num_phis)]
+    has_frontier = frontier is not None and len(frontier) > 0
+    if has_frontier:
+        d = np.asarray(frontier)[rng.randint(len(frontier), size=num_frontier)] - view_sphere.center
+        azimuths = np.arctan2(d[:, 1], d[:, 0])
+        angles += list(zip(rng.uniform(theta_min, theta_max, num_frontier), azimuths))
+    coarse = [view_sphere.get_view(theta, phi) for theta, phi in angles]
+    coarse += [view_sphere.sample_view(theta_max, rng) for _ in range(num_random)]
+
+    coarse_views, coarse_configs = reachable_views(coarse, q, solve_cam_ik)
+    if not coarse_views:
+        return [], [], np.zeros(0)
+    proxy = frontier_visibility(view_sphere, coarse_views, frontier) if has_frontier else np.zeros(len(coarse_views))
+    # Random order among equal scores, e.g. before anything is occluded
+    best = np.lexsort((rng.rand(len(coarse_views)), -proxy))[:num_refine]
+    views = [coarse_views[i] for i in best]
+    configs = [coarse_configs[i] for i in best]
+
+    # Refine around the best coarse views
+    d_theta = 0.5 * max(theta_max - theta_min, np.deg2rad(5.0))
+    d_phi = np.pi / num_phis
+    fine = []
+    for view in views:
+        theta, phi = view_angles(view_sphere, view)
+        for _ in range(samples_per_view):
+            fine.append(
+                view_sphere.get_view(
+                    np.clip(theta + rng.uniform(-d_theta, d_theta), 0.0, theta_max),
+                    phi + rng.uniform(-d_phi, d_phi),
+                )
+            )
+    fine_views, fine_configs = reachable_views(fine, q, solve_cam_ik)
+    views, configs = views + fine_views, configs + fine_configs
+    return views, configs, np.asarray(score_fn(views))
+
+
+def frontier_visibility(view_sphere, views, frontier):
+    # Number of frontier points on the side of the sphere center that faces each camera, a cheap
+    # stand-in for the information gain of views that haven't been raycast
+    d_views = np.array([v.translation for v in views]) - view_sphere.center
+    d_frontier = np.asarray(frontier) - view_sphere.center
+    return np.count_nonzero(d_views @ d_frontier.T > 0.0, axis=1)
+
+
+def reachable_views(views, q, solve_cam_ik):
+    reachable, configs = [], []
+    for view in views:
+        q_view = solve_cam_ik(q, view)
+        if q_view:
+            reachable.append(view)
+            configs.append(q_view)
+    return reachable, configs
+
+
+def view_angles(view_sphere, view):
+    # Polar and azimuth angle of the camera position on the view sphere
+    d = view.translation - view_sphere.center
+    return np.arccos(np.clip(d[2] / np.linalg.norm(d), -1.0, 1.0)), np.arctan2(d[1], d[0])
+
+
+def information_gain(tsdf_grid, voxel_size, intrinsic, view, bbox, T_task_base, occluded, downsample):
+    """Counts the occluded voxels inside the bbox that become visible from view.
+
+    tsdf_grid is the Open3D grid with values in [0, 1] and occluded an (N, 3) array with the
+    indices of the occluded voxels.
+    """
+    return information_gain_batch(
+        tsdf_grid, voxel_size, intrinsic, [view], bbox, T_task_base, occluded, downsample
+    )[0]
+
+
+def information_gain_batch(tsdf_grid, voxel_size, intrinsic, views, bbox, T_task_base, occluded, downsample):
+    """information_gain for several views.
+
+    Which voxels count towards the gain doesn't depend on the view, so the mask of occluded
+    rear side voxels inside the bbox is built once and each view only costs a raycast.
+    """
+    if len(occluded) == 0:
+        return np.zeros(len(views), dtype=int)
+    tsdf_grid = -1.0 + 2.0 * tsdf_grid  # Open3D maps tsdf to [0,1]
+    mask = candidate_mask(tsdf_grid, voxel_size, bbox, T_task_base)
+    occluded_mask = np.zeros(tsdf_grid.shape, dtype=bool)
+    occluded_mask[tuple(np.asarray(occluded, dtype=int).reshape(-1, 3).T)] = True
+    mask = (mask & occluded_mask).ravel()
+
+    gains = np.zeros(len(views), dtype=int)
+    for n, view in enumerate(views):
+        voxel_indices = cast_view_rays(tsdf_grid, voxel_size, intrinsic, view, bbox, T_task_base, downsample)
+        if len(voxel_indices) > 0:
+            # Duplicates are removed before counting
+            flat = np.unique(np.ravel_multi_index(tuple(voxel_indices.T), tsdf_grid.shape))
+            gains[n] = np.count_nonzero(mask[flat])
+    return gains
+
+
+def view_voxels(tsdf_grid, voxel_size, intrinsic, view, bbox, T_task_base, downsample):
+    """Returns the (N, 3) indices of the voxels behind a surface inside the bbox that the rays of
+    view traverse, the candidates for information_gain.
+
+    Doesn't depend on the occluded voxels, so it only has to be computed once per map and view.
+    """
+    tsdf_grid = -1.0 + 2.0 * tsdf_grid  # Open3D maps tsdf to [0,1]
+    voxel_indices = cast_view_rays(tsdf_grid, voxel_size, intrinsic, view, bbox, T_task_base, downsample)
+    if len(voxel_indices) == 0:
+        return np.empty((0, 3), dtype=int)
+    hit = np.zeros(tsdf_grid.shape, dtype=bool)
+    hit[tuple(voxel_indices.T)] = True
+    return np.argwhere(hit & candidate_mask(tsdf_grid, voxel_size, bbox, T_task_base))
+
+
+def candidate_mask(tsdf_grid, voxel_size, bbox, T_task_base):
+    # Rear side voxels within the bounding box, tsdf_grid is in [-1, 1]
+    bbox_min = T_task_base.apply(bbox.min) / voxel_size
+    bbox_max = T_task_base.apply(bbox.max) / voxel_size
+    indices = np.indices(tsdf_grid.shape).transpose(1, 2, 3, 0)
+    in_bbox = ((indices > bbox_min) & (indices < bbox_max)).all(axis=-1)
+    return in_bbox & (tsdf_grid > -1.0) & (tsdf_grid < 0.0)
+
+
+def cast_view_rays(tsdf_grid, voxel_size, intrinsic, view, bbox, T_task_base, downsample):
+    # Raycasts the pixels of the downsampled image that the bbox projects to, tsdf_grid in [-1, 1]
+
+    # Downsample the sensor resolution
+    fx = intrinsic.fx / downsample
+    fy = intrinsic.fy / downsample
+    cx = intrinsic.cx / downsample
+    cy = intrinsic.cy / downsample
+
+    # Project bbox onto the image plane to get better bounds
+    T_cam_base = view.inv()
+    corners = np.array([T_cam_base.apply(p) for p in bbox.corners]).T
+    u = (fx * corners[0] / corners[2] + cx).round().astype(int)
+    v = (fy * corners[1] / corners[2] + cy).round().astype(int)
+    u_min, u_max = u.min(), u.max()
+    v_min, v_max = v.min(), v.max()
+
+    t_min = 0.0
+    t_max = corners[2].max()  # This bound might be a bit too short
+    t_step = np.sqrt(3) * voxel_size  # Could be replaced with line rasterization
+
+    # Cast rays from the camera view (we'll work in the task frame from now on)
+    view = T_task_base * view
+    ori, pos = view.rotation.as_matrix(), view.translation
+
+    return cast_rays(
+        voxel_size, tsdf_grid, ori, pos, fx, fy, cx, cy,
+        u_min, u_max, v_min, v_max, t_min, t_max, t_step,
+    )
+
+
+class QualityHistory:
+    """Grasp quality of the last T predictions, stored sparsely in a ring buffer.
+
+    Each slot only keeps the sorted flat indices and values of the voxels whose quality is above
+    store_threshold, a few KB per prediction instead of a dense float32 grid. Voxels below it read
+    back as 0, like the slots that have not been written yet.
+    """
+
+    def __init__(self, T, resolution, store_threshold=0.5):
+        self.T = T
+        self.resolution = resolution
+        self.store_threshold = store_threshold
+        self.reset()
+
+    def reset(self):
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        self.slots = [empty] * self.T
+
+    def update(self, t, qual):
+        indices = np.flatnonzero(qual > self.store_threshold)
+        self.slots[t % self.T] = (indices, qual.ravel()[indices].astype(np.float32))
+
+    def query(self, positions, voxel_size):
+        """Returns a (T, N) array with the qualities at the N positions and an (N,) validity mask."""
+        index = (np.asarray(positions).reshape(-1, 3) / voxel_size).astype(int)
+        valid = ((index >= 0) & (index < self.resolution)).all(axis=1)
+        flat = np.ravel_multi_index(tuple(np.clip(index, 0, self.resolution - 1).T), (self.resolution,) * 3)
+        qs = np.zeros((self.T, len(flat)), dtype=np.float32)
+        for t, (indices, values) in enumerate(self.slots):
+            if len(indices) == 0:
+                continue
+            i = np.minimum(np.searchsorted(indices, flat), len(indices) - 1)
+            found = indices[i] == flat
+            qs[t, found] = values[i[found]]
+        return qs, valid
+
+    def is_stable(self, positions, voxel_size, threshold=0.9):
+        """Checks for every position if it had a nonzero quality in all of the last T updates
+        and a mean quality above threshold."""
+        qs, valid = self.query(positions, voxel_size)
+        return valid & (np.count_nonzero(qs, axis=0) == self.T) & (qs.mean(axis=0) > threshold)
+
+    def nbytes(self):
+        return sum(indices.nbytes + values.nbytes for indices, values in self.slots)
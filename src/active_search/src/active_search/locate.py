@@ -4,7 +4,7 @@ import pybullet as p
 import open3d as o3d
 
 from active_grasp.bbox import AABBox
-from .dynamic_perception import SceneTSDFVolume
+from .dynamic_perception import SceneTSDFVolume, configured_resolution
 from robot_helpers.spatial import Transform
 
 def get_target_bb(sim, uid):
@@ -28,7 +28,7 @@ def get_target_bb(sim, uid):
 def get_tsdf(sim, reset_tsdf= False):
         
     if reset_tsdf:
-        tsdf = SceneTSDFVolume(sim.scene.length, 40)
+        tsdf = SceneTSDFVolume(sim.scene.length, configured_resolution())
     
     cam_data = sim.camera.get_image()
     image = cam_data[0]
@@ -45,10 +45,7 @@ def get_poi_torch(tsdf, target_bb):
     print(resolution)
     print(voxel_size)
 
-    volume = tsdf.o3dvol.extract_volume_tsdf()
-    vol_array = np.asarray(volume)
-
-    vol_mat = vol_array[:,0].reshape(resolution, resolution, resolution)
+    vol_mat = np.ascontiguousarray(tsdf.get_volume()[..., 0])
     bb_voxel = np.array(np.floor(target_bb.get_extent()/voxel_size), int)
     print(bb_voxel)
     # bb_voxel = [10,10,10]
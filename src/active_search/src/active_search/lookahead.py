@@ -0,0 +1,109 @@
+import numpy as np
+from scipy import ndimage
+
+from active_search.search_policy import find_occluded_voxels_batch
+
+# Grasp lookahead without simulation. For every candidate grasp the object under the gripper is
+# segmented from the current volume, its footprint is marked as free space and the occlusion map
+# is recomputed. All hypotheses go through the occlusion search as one batch.
+#
+# This is not the map right after the grasp: tsdf_cut resets the region to unobserved, which
+# find_occluded_voxels counts as occluded. The voxels only become free once later views observe
+# the emptied region. Assuming all of it is free is the best case, so the results are upper
+# bounds on what removing the object and looking again can reveal.
+
+
+def segment_objects(volume, min_z=2):
+    """Labels the connected components of observed voxels behind a surface.
+
+    Voxels below min_z are ignored so that objects aren't connected through the table.
+    """
+    tsdf, weight = volume[..., 0], volume[..., 1]
+    occupied = (weight > 0) & (tsdf < 0)
+    occupied[:, :, :min_z] = False
+    labels, _ = ndimage.label(occupied)
+    return labels
+
+
+def object_regions(labels, indices, search_radius=2):
+    """Voxel bounds [lo, hi) of the object at each grasp index.
+
+    Falls back to the search window around the grasp when no object is found within it.
+    """
+    slices = ndimage.find_objects(labels)
+    resolution = np.asarray(labels.shape)
+    regions = []
+    for index in np.asarray(indices, dtype=int).reshape(-1, 3):
+        lo = np.clip(index - search_radius, 0, resolution)
+        hi = np.clip(index + search_radius + 1, 0, resolution)
+        window = labels[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+        ids = window[window > 0]
+        if len(ids) > 0:
+            s = slices[np.bincount(ids).argmax() - 1]
+            lo = np.array([d.start for d in s])
+            hi = np.array([d.stop for d in s])
+        regions.append((lo, hi))
+    return regions
+
+
+def removal_bounds(regions, padding, resolution):
+    # The object's footprint from the table up, padded by the truncation distance
+    lo = np.array([r[0] for r in regions]).reshape(-1, 3) - padding
+    hi = np.array([r[1] for r in regions]).reshape(-1, 3) + padding
+    lo[:, 2] = 0
+    return np.clip(lo, 0, resolution).astype(int), np.clip(hi, 0, resolution).astype(int)
+
+
+def grasp_removal_gain_bounds(volume, occ_mat, bb_size, indices, padding, device=None, batch_size=16):
+    """Upper bound on the number of occluded voxels that removing the object at each grasp index
+    and observing the emptied region would reveal.
+
+    volume is the (R, R, R, 2) array of tsdf.get_volume(), occ_mat the current result of
+    find_occluded_voxels and padding is in voxels. device defaults to cuda when available.
+    """
+    indices = np.asarray(indices, dtype=int).reshape(-1, 3)
+    if len(indices) == 0:
+        return np.zeros(0)
+    # Marking a region as free can only shrink the occlusion map, so the gain is the difference in size
+    before = float(np.sum(occ_mat))
+    batches = occlusion_after_removal(volume, bb_size, indices, padding, device, batch_size)
+    return np.concatenate([before - occ.sum(dim=(1, 2, 3)).cpu().numpy() for occ in batches])
+
+
+def grasp_removal_reveal_bounds(volume, occ_mat, bb_size, indices, padding, device=None, batch_size=16):
+    """Like grasp_removal_gain_bounds, but returns the (N, 3) indices of the voxels per grasp."""
+    indices = np.asarray(indices, dtype=int).reshape(-1, 3)
+    reveals = []
+    if len(indices) == 0:
+        return reveals
+    before = np.asarray(occ_mat) > 0
+    for occ in occlusion_after_removal(volume, bb_size, indices, padding, device, batch_size):
+        for after in occ.cpu().numpy() > 0:
+            reveals.append(np.argwhere(before & ~after))
+    return reveals
+
+
+def occlusion_after_removal(volume, bb_size, indices, padding, device=None, batch_size=16):
+    # Yields the (B, X, Y, Z) occlusion maps of the removal hypotheses batch by batch, with the
+    # removed regions marked as free
+    import torch
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    resolution = np.asarray(volume.shape[:3])
+    regions = object_regions(segment_objects(volume), indices)
+    lo, hi = removal_bounds(regions, padding, resolution)
+
+    device = torch.device(device)
+    vol_mat = torch.from_numpy(np.ascontiguousarray(volume[..., 0])).to(device)
+    axes = [torch.arange(n, device=device) for n in resolution]
+    lo, hi = torch.from_numpy(lo).to(device), torch.from_numpy(hi).to(device)
+
+    for start in range(0, len(indices), batch_size):
+        stop = min(start + batch_size, len(indices))
+        # (B, R) masks per axis, their outer product selects each hypothesis' region
+        x, y, z = [(a >= lo[start:stop, d, None]) & (a < hi[start:stop, d, None]) for d, a in enumerate(axes)]
+        mask = x[:, :, None, None] & y[:, None, :, None] & z[:, None, None, :]
+        vol_mats = torch.where(mask, torch.ones_like(vol_mat), vol_mat.expand(stop - start, -1, -1, -1))
+        yield find_occluded_voxels_batch(vol_mats, bb_size)
@@ -4,13 +4,45 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import os
+import copy
+
+
+def amp_dtype(device):
+    # Autocast dtype for a device, bf16 is the one well supported by CPU kernels
+    return torch.float16 if device.type == "cuda" else torch.bfloat16
+
+
+def unpack_occupancy(packed, resolution):
+    """Expands (B, ceil(R^3/8)) bit-packed uint8 occlusion grids to (B, 1, R, R, R) floats.
+
+    Matches the big endian bit order of np.packbits. The grids are sent to the device packed
+    and only expanded here, right before they are fed to the first Conv3d.
+    """
+    shifts = torch.arange(7, -1, -1, device=packed.device, dtype=torch.uint8)
+    bits = (packed.unsqueeze(-1) >> shifts) & 1
+    bits = bits.view(packed.shape[0], -1)[:, : resolution**3]
+    return bits.reshape(-1, 1, resolution, resolution, resolution).float()
+
+
+def join_channels(tsdf, packed_occupancy):
+    # (B, R, R, R) tsdf and (B, ceil(R^3/8)) packed occlusion grids -> (B, 2, R, R, R) encoder input
+    resolution = tsdf.shape[-1]
+    return torch.cat((tsdf.float().unsqueeze(1), unpack_occupancy(packed_occupancy, resolution)), 1)
 
 
 class Autoencoder(nn.Module):
-    def __init__(self):
+    def __init__(self, resolution=40):
         super(Autoencoder, self).__init__()
 
+        # The two pooling layers shrink the grid by 4 before the latent projection
+        if resolution % 4 != 0:
+            raise ValueError("Autoencoder needs a resolution divisible by 4, got {}".format(resolution))
+        self.resolution = resolution
+        size = resolution // 4
+
         self.get_path()
+        self.amp = False
+        self.channels_last = False
 
         # Encoder layers
         self.encoder = nn.Sequential(
@@ -27,14 +59,14 @@ class Autoencoder(nn.Module):
             nn.ReLU(),
 
             nn.Flatten(),  # Flatten the 3D tensor into a 1D vector
-            nn.Linear(128 * 10 * 10 * 10, 512)
+            nn.Linear(128 * size * size * size, 512)
         )
 
         # Decoder layers
         self.decoder = nn.Sequential(
 
-            nn.Linear(512, 128 * 10 * 10 * 10),  # Map from the latent space back to the decoder input shape
-            nn.Unflatten(1, (128, 10, 10, 10)),  # Reshape the tensor back to 4D (batch_size, channels, height, width, depth)
+            nn.Linear(512, 128 * size * size * size),  # Map from the latent space back to the decoder input shape
+            nn.Unflatten(1, (128, size, size, size)),  # Reshape the tensor back to 4D (batch_size, channels, height, width, depth)
             nn.ReLU(),
 
             nn.Conv3d(128, 64, kernel_size=3, stride=1, padding=1),
@@ -54,10 +86,27 @@ class Autoencoder(nn.Module):
         decoded = self.decoder(encoded)
         return decoded 
     
+    def configure_inference(self, device, amp=False, channels_last=True):
+        self.amp = amp
+        self.channels_last = channels_last
+        memory_format = torch.channels_last_3d if channels_last else torch.contiguous_format
+        self.to(device, memory_format=memory_format).float().eval()
+
+    def encode(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+        with torch.no_grad(), torch.autocast(x.device.type, dtype=amp_dtype(x.device), enabled=self.amp):
+            return self.encoder(x).float()
+
+    def encode_packed(self, tsdf, packed_occupancy):
+        return self.encode(join_channels(tsdf, packed_occupancy))
+
     def get_path(self):
         rospack = rospkg.RosPack()
         pkg_root = Path(rospack.get_path("active_search"))
-        self.model_path =  str(pkg_root)+"/models/autoencoder_weights.pth"
+        # Weights only fit the resolution they were trained for
+        suffix = "" if self.resolution == 40 else "_{}".format(self.resolution)
+        self.model_path =  str(pkg_root)+"/models/autoencoder_weights{}.pth".format(suffix)
 
 
 class GraspEval(nn.Module):
@@ -112,3 +161,86 @@ class ViewEval(nn.Module):
     def load_model(self):
         self.load_state_dict(torch.load(self.model_path))
     
+
+
+class PolicyNetwork(nn.Module):
+    """Encoder and both Q heads in one module, this is what gets exported for inference.
+
+    forward encodes the scene into the state vector, grasp_values and view_values evaluate the
+    heads on (state, pose) inputs. The decoder is not part of it.
+    """
+
+    def __init__(self, encoder, grasp_nn, view_nn):
+        super(PolicyNetwork, self).__init__()
+        self.encoder = encoder
+        self.grasp_head = grasp_nn
+        self.view_head = view_nn
+
+    def forward(self, tsdf, packed_occupancy, q):
+        encoded = self.encoder(join_channels(tsdf, packed_occupancy))
+        return torch.cat((encoded, q.float()), 1)
+
+    @torch.jit.export
+    def grasp_values(self, x):
+        return self.grasp_head(x)
+
+    @torch.jit.export
+    def view_values(self, x):
+        return self.view_head(x)
+
+
+def exported_policy_path():
+    rospack = rospkg.RosPack()
+    pkg_root = Path(rospack.get_path("active_search"))
+    return str(pkg_root)+"/models/policy_scripted.pt"
+
+
+def load_policy_network(path, device):
+    net = torch.jit.load(str(path), map_location=device)
+    net.eval()
+    return net
+
+
+class QuantizableEncoder(nn.Module):
+    """Autoencoder.encoder split for int8 inference on the CPU.
+
+    The conv blocks are statically quantized (calibrated on recorded TSDFs), the large
+    Linear(128*(R/4)^3, 512) is dynamically quantized as its activations are not calibrated.
+    """
+
+    def __init__(self, encoder):
+        super(QuantizableEncoder, self).__init__()
+        self.quant = torch.ao.quantization.QuantStub()
+        self.features = nn.Sequential(*list(encoder.children())[:-2])
+        self.dequant = torch.ao.quantization.DeQuantStub()
+        self.flatten = encoder[-2]
+        self.fc = encoder[-1]
+
+    def forward(self, x):
+        x = self.dequant(self.features(self.quant(x)))
+        return self.fc(self.flatten(x))
+
+    def fuse(self):
+        convs = [i for i, m in enumerate(self.features) if isinstance(m, nn.Conv3d)]
+        torch.ao.quantization.fuse_modules(self.features, [[str(i), str(i + 1)] for i in convs], inplace=True)
+
+
+def quantize_encoder(encoder, calibration_batches, static=True):
+    model = QuantizableEncoder(copy.deepcopy(encoder)).cpu().eval()
+    if static:
+        model.fuse()
+        model.qconfig = torch.ao.quantization.get_default_qconfig("fbgemm")
+        model.fc.qconfig = None
+        torch.ao.quantization.prepare(model, inplace=True)
+        with torch.no_grad():
+            for x in calibration_batches:
+                model(x)
+        torch.ao.quantization.convert(model, inplace=True)
+    torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def quantized_encoder_path():
+    rospack = rospkg.RosPack()
+    pkg_root = Path(rospack.get_path("active_search"))
+    return str(pkg_root)+"/models/encoder_int8.pt"
@@ -0,0 +1,47 @@
+import functools
+
+import numpy as np
+
+# Execution time estimates for the candidate views. A view is reached with the cartesian
+# velocity controller, so the time is bounded below by the camera's travel at linear_vel and by
+# the joint travel at joint_vel. Camera positions come from forward kinematics of the ik
+# solutions that generate_views already computed.
+
+
+class MotionCost:
+    def __init__(self, model=None, linear_vel=0.05, joint_vel=1.0, max_time=3.0, cache_size=4096):
+        self.model = model  # robot_helpers.model.KDLModel from the base to the camera frame
+        self.linear_vel = linear_vel
+        self.joint_vel = joint_vel
+        self.max_time = max_time  # views are executed for at most this long
+        # Forward kinematics of the rounded configurations, least recently used entries are dropped
+        self.fk = functools.lru_cache(maxsize=cache_size)(self.camera_position_uncached)
+
+    def camera_position(self, q):
+        return self.fk(tuple(np.round(q, 4)))
+
+    def camera_position_uncached(self, key):
+        return self.model.pose(np.asarray(key)).translation
+
+    def __call__(self, q, configs, x=None, views=None):
+        """Returns the estimated time in seconds to move from q to each of configs.
+
+        Without a kinematic model the camera travel is measured from the current camera pose x
+        to the views instead, and only the joint travel is used if those aren't given either.
+        Views that are None, e.g. for grasps, only count the joint travel.
+        """
+        if len(configs) == 0:
+            return np.zeros(0)
+        configs = np.asarray(configs, dtype=float)
+        time = np.abs(configs - np.asarray(q)).max(axis=1) / self.joint_vel
+
+        if self.model is not None:
+            start = self.camera_position(q)
+            targets = np.array([self.camera_position(c) for c in configs])
+        elif x is not None and views is not None:
+            start = x.translation
+            targets = np.array([start if v is None else v.translation for v in views])
+        else:
+            return np.minimum(time, self.max_time)
+        time = np.maximum(time, np.linalg.norm(targets - start, axis=1) / self.linear_vel)
+        return np.minimum(time, self.max_time)
@@ -1,5 +1,5 @@
-import itertools
-from numba import jit
+import time
+
 import numpy as np
 import rospy
 
@@ -7,51 +7,6 @@ from active_search.search_policy import MultiViewPolicy
 from active_grasp.timer import Timer
 
 
-@jit(nopython=True)
-def get_voxel_at(voxel_size, p):
-    index = (p / voxel_size).astype(np.int64)
-    return index if (index >= 0).all() and (index < 40).all() else None
-
-
-# Note that the jit compilation takes some time the first time raycast is called
-@jit(nopython=True)
-def raycast(
-    voxel_size,
-    tsdf_grid,
-    ori,
-    pos,
-    fx,
-    fy,
-    cx,
-    cy,
-    u_min,
-    u_max,
-    v_min,
-    v_max,
-    t_min,
-    t_max,
-    t_step,
-):
-    voxel_indices = []
-    for u in range(u_min, u_max):
-        for v in range(v_min, v_max):
-            direction = np.asarray([(u - cx) / fx, (v - cy) / fy, 1.0])
-            direction = ori @ (direction / np.linalg.norm(direction))
-            t, tsdf_prev = t_min, -1.0
-            while t < t_max:
-                p = pos + t * direction
-                t += t_step
-                index = get_voxel_at(voxel_size, p)
-                if index is not None:
-                    i, j, k = index
-                    tsdf = tsdf_grid[i, j, k]
-                    if tsdf * tsdf_prev < 0 and tsdf_prev > -1:  # crossed a surface
-                        break
-                    voxel_indices.append(index)
-                    tsdf_prev = tsdf
-    return voxel_indices
-
-
 class NextBestView(MultiViewPolicy):
     def __init__(self):
         super().__init__()
@@ -59,28 +14,47 @@ class NextBestView(MultiViewPolicy):
         self.max_views = rospy.get_param("nbv_grasp/max_views")
         self.min_gain = rospy.get_param("nbv_grasp/min_gain")
         self.downsample = rospy.get_param("nbv_grasp/downsample")
-        self.compile()
-
-    def compile(self):
-        # Trigger the JIT compilation
-        raycast(
-            1.0,
-            np.zeros((40, 40, 40), dtype=np.float32),
-            np.eye(3),
-            np.zeros(3),
-            1.0,
-            1.0,
-            1.0,
-            1.0,
-            0,
-            1,
-            0,
-            1,
-            0.0,
-            1.0,
-            0.1,
+        self.view_sampler = rospy.get_param("nbv_grasp/view_sampler", "grid")
+        self.time_weight = rospy.get_param("nbv_grasp/time_weight", 1.0)
+        self.init_motion_cost()
+        self.init_planner()
+
+    def init_motion_cost(self):
+        from active_search.motion_cost import MotionCost
+
+        model = None
+        try:
+            from robot_helpers.model import KDLModel
+        except ImportError as e:
+            rospy.logwarn("Motion cost falls back to the view poses, no kinematic model: {}".format(e))
+        else:
+            if rospy.has_param("robot_description"):
+                model = KDLModel.from_parameter_server(self.base_frame, self.cam_frame)
+            else:
+                rospy.logwarn("Motion cost falls back to the view poses, robot_description isn't set")
+        self.motion_cost = MotionCost(
+            model,
+            linear_vel=rospy.get_param("~linear_vel", 0.05),
+            joint_vel=rospy.get_param("nbv_grasp/joint_vel", 1.0),
         )
 
+    def init_planner(self):
+        # "greedy" picks the best single view, "beam" plans sequences, see active_search.planning
+        from active_search.planning import BeamSearchPlanner
+
+        self.planner = None
+        self.plan_grasps = False
+        if rospy.get_param("nbv_grasp/planner", "greedy") == "beam":
+            self.planner = BeamSearchPlanner(
+                self.motion_cost,
+                horizon=rospy.get_param("nbv_grasp/horizon", 3),
+                beam_width=rospy.get_param("nbv_grasp/beam_width", 4),
+                time_budget=rospy.get_param("nbv_grasp/time_budget", 0.5),
+                discount=rospy.get_param("nbv_grasp/discount", 0.9),
+                cost_weight=rospy.get_param("nbv_grasp/cost_weight", 5.0),
+            )
+            self.plan_grasps = rospy.get_param("nbv_grasp/plan_grasps", False)
+
     def activate(self, bbox, view_sphere):
         super().activate(bbox, view_sphere)
 
@@ -94,13 +68,18 @@ class NextBestView(MultiViewPolicy):
             print("not grasping")
             with Timer("state_update"):
                 self.integrate(img, x, q)
+            if self.plan_grasps:
+                # Grasp actions are built from the grasps of the current map
+                self.get_grasps(q)
+            if self.planner is not None:
+                self.plan_next_action(q, x)
+                return
             with Timer("view_generation"):
-                views = self.generate_views(q)
-            with Timer("ig_computation"):
-                gains = [self.ig_fn(v, self.downsample) for v in views]
+                views, configs, gains = self.candidate_views(q)
             with Timer("cost_computation"):
-                costs = [self.cost_fn(v) for v in views]
-            utilities = gains / np.sum(gains) - costs / np.sum(costs)
+                costs = self.cost_fn(q, x, views, configs)
+            # Gain traded against the estimated execution time, both normalized over the candidates
+            utilities = gains / max(np.sum(gains), 1) - self.time_weight * costs / max(np.sum(costs), 1e-6)
             self.vis.ig_views(self.base_frame, self.intrinsic, views, utilities)
             i = np.argmax(utilities)
             nbv, gain = views[i], gains[i]
@@ -113,95 +92,78 @@ class NextBestView(MultiViewPolicy):
 
             self.x_d = nbv
 
-    def best_grasp_prediction_is_stable(self):
-        if self.best_grasp:
-            t = (self.T_task_base * self.best_grasp.pose).translation
-            i, j, k = (t / self.tsdf.voxel_size).astype(int)
-            qs = self.qual_hist[:, i, j, k]
-            if np.count_nonzero(qs) == self.T and np.mean(qs) > 0.9:
-                return True
-        return False
-
-    def generate_views(self, q):
-        thetas = np.deg2rad([15, 30])
-        phis = np.arange(8) * np.deg2rad(45)
-        view_candidates = []
-        for theta, phi in itertools.product(thetas, phis):
-            view = self.view_sphere.get_view(theta, phi)
-            if self.solve_cam_ik(q, view):
-                view_candidates.append(view)
-        print("generating",len(view_candidates),"views")
-        return view_candidates
-
-    def ig_fn(self, view, downsample):
-        tsdf_grid, voxel_size = self.tsdf.get_grid(), self.tsdf.voxel_size
-        tsdf_grid = -1.0 + 2.0 * tsdf_grid  # Open3D maps tsdf to [0,1]
-
-        # Downsample the sensor resolution
-        fx = self.intrinsic.fx / downsample
-        fy = self.intrinsic.fy / downsample
-        cx = self.intrinsic.cx / downsample
-        cy = self.intrinsic.cy / downsample
-
-        # Project bbox onto the image plane to get better bounds
-        T_cam_base = view.inv()
-        corners = np.array([T_cam_base.apply(p) for p in self.bbox.corners]).T
-        u = (fx * corners[0] / corners[2] + cx).round().astype(int)
-        v = (fy * corners[1] / corners[2] + cy).round().astype(int)
-        u_min, u_max = u.min(), u.max()
-        v_min, v_max = v.min(), v.max()
-
-        t_min = 0.0  # self.min_z_dist
-        t_max = corners[2].max()  # This bound might be a bit too short
-        t_step = np.sqrt(3) * voxel_size  # Could be replaced with line rasterization
-
-        # Cast rays from the camera view (we'll work in the task frame from now on)
-        view = self.T_task_base * view
-        ori, pos = view.rotation.as_matrix(), view.translation
-
-        voxel_indices = raycast(
-            voxel_size,
-            tsdf_grid,
-            ori,
-            pos,
-            fx,
-            fy,
-            cx,
-            cy,
-            u_min,
-            u_max,
-            v_min,
-            v_max,
-            t_min,
-            t_max,
-            t_step,
-        )
-
-        # Count rear side voxels within the bounding box
-        # indices_list = np.unique(voxel_indices, axis=0)
-        # print(indices_list)
-        indices = set(map(tuple, voxel_indices)) 
-        # print(indices)
-        indices = indices.intersection(self.coord_set)
-        indices_list = list(indices)
-        
-        bbox_min = self.T_task_base.apply(self.bbox.min) / voxel_size
-        bbox_max = self.T_task_base.apply(self.bbox.max) / voxel_size
-        mask = np.array([((i > bbox_min) & (i < bbox_max)).all() for i in indices_list], dtype = int)
-        # i, j, k = indices_list[mask].T
-        # i, j, k = zip(*indices_list[mask])
-        if len(indices_list) == 0:
-            return 0
-        try:
-            i, j, k = zip(*[tpl for i, tpl in enumerate(indices_list) if mask[i]])
-        except:
-            return 0
-
+    def plan_next_action(self, q, x):
+        from active_search.planning import Action
+
+        # Candidate generation, the raycasts and the search all share the planner's time budget
+        deadline = time.time() + self.planner.time_budget
+        with Timer("view_generation"):
+            views, configs, _ = self.candidate_views(q, score=False)
+        with Timer("ig_computation"):
+            actions = []
+            for v, q_v in zip(views, configs):
+                if actions and time.time() > deadline:
+                    break
+                actions.append(Action("view", v, q_v, self.view_voxels(v, self.downsample)))
+        views = [a.target for a in actions]
+        if self.plan_grasps and time.time() < deadline:
+            actions += self.grasp_actions(q)
+        if len(actions) == 0:
+            self.done = True
+            return
 
-        tsdfs = tsdf_grid[i, j, k]
-        ig = np.logical_and(tsdfs > -1.0, tsdfs < 0.0).sum()
+        occluded = np.zeros((self.tsdf.resolution,) * 3, dtype=bool)
+        occluded[tuple(self.coordinate_mat.T)] = True
+        with Timer("planning"):
+            sequence, values = self.planner.plan(q, x, occluded, actions, deadline)
 
-        return ig
+        self.vis.ig_views(self.base_frame, self.intrinsic, views, values[: len(views)])
+        action = actions[sequence[0]]
+        gain = np.count_nonzero(occluded[tuple(action.voxels.T)])
+        print(action.kind, gain, "plan", [actions[i].kind for i in sequence])
 
-    def cost_fn(self, view):
-        return 1.0
+        if action.kind == "grasp":
+            # The controller executes best_grasp once the policy is done and cuts it from the map
+            self.best_grasp = action.target
+            self.done = True
+        elif gain < self.min_gain and len(self.views) > self.T:
+            print("done")
+            self.done = True
+        else:
+            self.x_d = action.target
+
+    def candidate_views(self, q, score=True):
+        # Returns the views with their ik solutions and information gains. The adaptive sampler
+        # needs gains to pick the views to refine, without score they come from the view_voxels
+        # cache so that the planner's actions reuse the raycasts
+        if self.view_sampler == "adaptive":
+            if not score:
+                return self.sample_views(q, self.downsample, lambda views: self.view_gains(views, self.downsample))
+            return self.sample_views(q, self.downsample)
+        views, configs = self.generate_views(q, return_configs=True)
+        if not score:
+            return views, configs, None
+        with Timer("ig_computation"):
+            gains = self.ig_batch(views, self.downsample)
+        return views, configs, gains
+
+    def grasp_actions(self, q):
+        from active_search.lookahead import grasp_removal_reveal_bounds
+        from active_search.planning import Action
+
+        grasps = getattr(self, "grasps", [])
+        if len(grasps) == 0 or not hasattr(self, "occ_mat"):
+            return []
+        indices = (self.task_positions(grasps) / self.tsdf.voxel_size).astype(int)
+        padding = int(np.ceil(self.tsdf.sdf_trunc / self.tsdf.voxel_size))
+        reveals = grasp_removal_reveal_bounds(self.tsdf.get_volume(), self.occ_mat, self.bb_size, indices, padding)
+        actions = []
+        for grasp, voxels in zip(grasps, reveals):
+            q_grasp = self.solve_ee_ik(q, grasp.pose * self.T_grasp_ee)
+            if q_grasp is not None:
+                actions.append(Action("grasp", grasp, q_grasp, voxels))
+        return actions
+
+    def cost_fn(self, q, x, views, configs):
+        # Seconds to reach each view from the current configuration
+        return self.motion_cost(q, configs, x, views)
@@ -1,6 +1,7 @@
 import open3d as o3d
 import numpy as np
 import threading
+import time
 import rospy
 import copy
 import ros_numpy
@@ -16,6 +17,9 @@ from robot_helpers.spatial import Transform
 
 class Open3d_viz():
     def __init__(self):
+        self.stamp = None
+        self.last_update = 0.0
+        self.period = 1.0 / rospy.get_param("~viz_rate", 5.0)
         self.init_tsdf_stream()
         
     def init_tsdf_stream(self):
@@ -24,18 +28,23 @@ class Open3d_viz():
         # rospy.Subscriber('/map_cloud', PointCloud2, self.sensor_cb)
         rospy.wait_for_service("get_map_cloud")
         # rospy.Service("get_map_cloud", vgn.srv.GetMapCloud, self.get_tsdf)
-        tsdf = rospy.ServiceProxy('get_map_cloud', vgn.srv.GetMapCloud)
-        self.get_tsdf(tsdf())
+        self.map_cloud_srv = rospy.ServiceProxy('get_map_cloud', vgn.srv.GetMapCloud, persistent=True)
+        self.get_tsdf(self.map_cloud_srv())
 
     def update(self):
-        tsdf = rospy.ServiceProxy('get_map_cloud', vgn.srv.GetMapCloud)
-        self.get_tsdf(tsdf())
+        # Polls the server at most at ~viz_rate, returns whether a new map arrived
+        if time.time() - self.last_update < self.period:
+            return False
+        self.last_update = time.time()
+        return self.get_tsdf(self.map_cloud_srv())
 
     def get_tsdf(self, req):
-        # print('sensor callback')
-        # self.tsdf_msg = req
-        # req = copy.deepcopy(self.tsdf_msg)
+        # The server hands out the same snapshot until the map changes
+        if req.map_cloud.header.stamp == self.stamp:
+            return False
+        self.stamp = req.map_cloud.header.stamp
         self.points, self.distances = from_cloud_msg(req.map_cloud)
+        return True
         # self.tsdf = map_cloud_to_grid(0.0075, points, distances)
 
     def center_view(self, vis):
@@ -108,25 +117,27 @@ class Open3d_viz():
         vis.update_renderer()
         vis.remove_geometry(tsdf_init, reset_bounding_box = reset_bb)
 
+        new_map = True
         while self.o3d_window_active:
-            if tsdf_exists:
-                vis.remove_geometry(tsdf_mesh, reset_bounding_box = reset_bb)
-                vis.remove_geometry(bb, reset_bounding_box = reset_bb)
+            if new_map:
+                if tsdf_exists:
+                    vis.remove_geometry(tsdf_mesh, reset_bounding_box = reset_bb)
+                    vis.remove_geometry(bb, reset_bounding_box = reset_bb)
 
-            tsdf_mesh = self.to_pc()
+                tsdf_mesh = self.to_pc()
 
-            tsdf_exists = True
+                tsdf_exists = True
 
-            bb = tsdf_mesh.get_axis_aligned_bounding_box()
-            bb.color = [1, 0, 0] 
+                bb = tsdf_mesh.get_axis_aligned_bounding_box()
+                bb.color = [1, 0, 0] 
 
-            vis.add_geometry(tsdf_mesh, reset_bounding_box = reset_bb)
-            vis.add_geometry(bb, reset_bounding_box = reset_bb)
+                vis.add_geometry(tsdf_mesh, reset_bounding_box = reset_bb)
+                vis.add_geometry(bb, reset_bounding_box = reset_bb)
 
             vis.poll_events()
             vis.update_renderer()
 
-            self.update()
+            new_map = self.update()
 
     def run(self):
         self.thread_open3d = threading.Thread(target=self.open3d_window, args= (False,))
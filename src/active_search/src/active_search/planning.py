@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+
+# Receding horizon view planning. A beam search looks a few actions (views or grasp removals)
+# ahead and only the first action of the best sequence is executed before planning again.
+#
+# Every action is described by the voxels it would reveal: the occluded candidates along the
+# rays of a view (kernels.view_voxels), or an upper bound on what a grasp removal frees
+# (lookahead). The gain of an action is the number of those voxels that are still occluded,
+# taking an action clears them. The resulting map only depends on the set of actions taken, which is used as the key of
+# the transposition table so that permutations of the same actions are evaluated once.
+
+
+class Action:
+    def __init__(self, kind, target, q, voxels):
+        self.kind = kind  # "view" or "grasp"
+        self.target = target  # the view pose or the Grasp
+        self.q = np.asarray(q, dtype=float)  # joint configuration reached by the action
+        self.voxels = np.asarray(voxels, dtype=int).reshape(-1, 3)
+
+
+class Node:
+    def __init__(self, taken, sequence, q, x, occluded, value):
+        self.taken = taken  # frozenset of action indices, identifies the map state
+        self.sequence = sequence
+        self.q = q
+        self.x = x  # camera pose, None after a grasp
+        self.occluded = occluded
+        self.value = value
+
+
+class BeamSearchPlanner:
+    def __init__(self, motion_cost, horizon=3, beam_width=4, time_budget=0.5, discount=0.9, cost_weight=5.0):
+        self.motion_cost = motion_cost  # active_search.motion_cost.MotionCost, the greedy policy's cost
+        self.horizon = horizon
+        self.beam_width = beam_width
+        self.time_budget = time_budget
+        self.discount = discount
+        self.cost_weight = cost_weight  # gain in voxels that is worth 1 s of motion
+
+    def plan(self, q, x, occluded, actions, deadline=None):
+        """Returns the best sequence of action indices and the value of the best sequence
+        starting with each action.
+
+        x is the current camera pose and occluded a boolean grid of the currently occluded
+        voxels. Transitions cost the time estimated by motion_cost. The tree is expanded until
+        the deadline (a time.time() value, time_budget from now by default) passes, checked before
+        every expansion. If the first level isn't finished by then, the plan falls back to the greedy
+        choice, the action with the best one step value.
+        """
+        if deadline is None:
+            deadline = time.time() + self.time_budget
+        gains = {}  # transposition table, (map state, action) -> gain
+        first_values = np.full(len(actions), -np.inf)
+        configs = [a.q for a in actions]
+        poses = camera_poses(actions)
+        beam = [Node(frozenset(), (), np.asarray(q, dtype=float), x, occluded, 0.0)]
+        best = None
+
+        for depth in range(self.horizon):
+            children = {}
+            for node in beam:
+                costs = self.motion_cost(node.q, configs, node.x, poses)
+                for i, action in enumerate(actions):
+                    if i in node.taken:
+                        continue
+                    if time.time() > deadline:
+                        break
+                    key = (node.taken, i)
+                    if key not in gains:
+                        gains[key] = np.count_nonzero(node.occluded[tuple(action.voxels.T)])
+                    value = node.value + self.discount**depth * (gains[key] - self.cost_weight * costs[i])
+                    # Sequences reaching the same map with the same last action are equivalent
+                    child_key = (node.taken | {i}, i)
+                    if child_key not in children or children[child_key][2] < value:
+                        children[child_key] = (node, i, value)
+            if depth == 0 and len(children) < len(actions):
+                return self.greedy(q, x, occluded, actions)
+            if not children:
+                break
+
+            ranked = sorted(children.values(), key=lambda c: c[2], reverse=True)
+            for node, i, value in ranked:
+                first = node.sequence[0] if node.sequence else i
+                first_values[first] = max(first_values[first], value)
+
+            beam = []
+            for node, i, value in ranked[: self.beam_width]:
+                occluded = node.occluded.copy()
+                occluded[tuple(actions[i].voxels.T)] = False
+                beam.append(Node(node.taken | {i}, node.sequence + (i,), actions[i].q, poses[i], occluded, value))
+            if best is None or beam[0].value > best.value:
+                best = beam[0]
+            if time.time() > deadline:
+                break
+
+        return (best.sequence if best else ()), first_values
+
+    def greedy(self, q, x, occluded, actions):
+        # One step values of all actions, the gains come from a single lookup of all voxels
+        if len(actions) == 0:
+            return (), np.zeros(0)
+        voxels = np.concatenate([a.voxels for a in actions])
+        hits = occluded[tuple(voxels.T)].astype(int)
+        offsets = np.cumsum([0] + [len(a.voxels) for a in actions])
+        gains = np.diff(np.concatenate([[0], np.cumsum(hits)])[offsets])
+        costs = self.motion_cost(q, [a.q for a in actions], x, camera_poses(actions))
+        values = gains - self.cost_weight * costs
+        return (int(np.argmax(values)),), values
+
+
+def camera_poses(actions):
+    # The camera pose an action ends in, unknown for grasps
+    return [a.target if a.kind == "view" else None for a in actions]
@@ -9,11 +9,9 @@ from std_msgs.msg import Bool
 from std_srvs.srv import Empty
 from random import sample
 import geometry_msgs.msg
-import trimesh
 import threading
 import time
 import csv
-from torch.utils.tensorboard import SummaryWriter
 
 
 from active_grasp.bbox import from_bbox_msg, AABBox
@@ -25,8 +23,9 @@ from robot_helpers.ros.panda import PandaArmClient, PandaGripperClient
 from robot_helpers.ros.moveit import MoveItClient, create_collision_object_from_mesh
 from robot_helpers.spatial import Rotation, Transform
 from vgn.utils import look_at, cartesian_to_spherical, spherical_to_cartesian
-from vgn.detection import select_local_maxima
-import torch
+
+# torch, tensorboard, trimesh and vgn.detection are imported where they are used to keep
+# importing the controller cheap
 
 
 class GraspController:
@@ -50,6 +49,14 @@ class GraspController:
         self.control_rate = rospy.get_param("~control_rate")
         self.linear_vel = rospy.get_param("~linear_vel")
         self.policy_rate = rospy.get_param("policy/rate")
+        # A view is executed until the camera reached it and the occlusion count settled, or for
+        # at most max_time seconds
+        self.view_max_time = rospy.get_param("~view_execution/max_time", 3.0)
+        self.view_position_tol = rospy.get_param("~view_execution/position_tol", 0.01)
+        self.view_angle_tol = rospy.get_param("~view_execution/angle_tol", 0.05)
+        self.view_occlusion_tol = rospy.get_param("~view_execution/occlusion_tol", 2)
+        self.view_settle_steps = rospy.get_param("~view_execution/settle_steps", 2)
+        self.view_durations = []
     
     def init_service_proxies(self):
         self.reset_env = rospy.ServiceProxy("reset", Reset)
@@ -89,6 +96,8 @@ class GraspController:
         rospy.Subscriber(self.depth_topic, Image, self.sensor_cb, queue_size=1)
 
     def init_tensorboard(self):
+        from torch.utils.tensorboard import SummaryWriter
+
         self.writer = SummaryWriter()
         self.frame = 0
 
@@ -100,16 +109,19 @@ class GraspController:
             self.complete = True
 
     def run(self):
+        import torch
+
+        self.policy.require_trainable()
         self.policy.init_tsdf()
         self.policy.target_bb = self.reset()
         self.complete = False
-        voxel_size = 0.0075
+        length = self.policy.tsdf.length
         x_off = 0.35
         y_off = -0.15
         z_off = 0.2
 
         bb_min = [x_off,y_off,z_off]
-        bb_max = [40*voxel_size+x_off,40*voxel_size+y_off,40*voxel_size+z_off]
+        bb_max = [length+x_off,length+y_off,length+z_off]
         self.bbox = AABBox(bb_min, bb_max)
 
         self.view_sphere = ViewHalfSphere(self.bbox, self.min_z_dist)
@@ -180,19 +192,7 @@ class GraspController:
                 grasp_mask.append(1)
                 view_mask.append(0)
             elif view:
-                start_time = time.time()
-                t = 0
-                self.policy.x_d = action
-                timer = rospy.Timer(rospy.Duration(1.0 / self.control_rate), self.send_vel_cmd)
-                print("Executing for: 3 seconds")
-                while t < (3.0):
-                    img, pose, q = self.get_state()
-                    self.policy.integrate(img, pose, q)
-                    t += 1/self.policy_rate
-                    r.sleep()
-                rospy.sleep(0.2)        
-                timer.shutdown()
-                exec_time = time.time() - start_time
+                exec_time = self.execute_view(action, r)
                 occ_diff = torch.tensor(float(10-10*(len(self.policy.coordinate_mat)/init_occ)), requires_grad= True).to("cuda")  #+ve diff is good
                 grasp_mask.append(0)
                 view_mask.append(1)
@@ -309,10 +309,12 @@ class GraspController:
         return info
     
     def run_policy(self, scene):
+        import torch
+
         self.policy.init_tsdf()
         self.policy.target_bb = self.reset()
         self.complete = False
-        voxel_size = 0.0075
+        length = self.policy.tsdf.length
         x_off = 0.35
         y_off = -0.15
         z_off = 0.2
@@ -320,7 +322,7 @@ class GraspController:
         self.log_policy_perf(scene)
 
         bb_min = [x_off,y_off,z_off]
-        bb_max = [40*voxel_size+x_off,40*voxel_size+y_off,40*voxel_size+z_off]
+        bb_max = [length+x_off,length+y_off,length+z_off]
         self.bbox = AABBox(bb_min, bb_max)
 
         self.view_sphere = ViewHalfSphere(self.bbox, self.min_z_dist)
@@ -379,19 +381,7 @@ class GraspController:
                 print("occupancy diff:", occ_diff)
                 exec_time = time.time() - start_time
             elif view:
-                start_time = time.time()
-                t = 0
-                self.policy.x_d = action
-                timer = rospy.Timer(rospy.Duration(1.0 / self.control_rate), self.send_vel_cmd)
-                print("Executing for: 3 seconds")
-                while t < (3.0):
-                    img, pose, q = self.get_state()
-                    self.policy.integrate(img, pose, q)
-                    t += 1/self.policy_rate
-                    r.sleep()
-                rospy.sleep(0.2)        
-                timer.shutdown()
-                exec_time = time.time() - start_time
+                exec_time = self.execute_view(action, r)
                 occ_diff = torch.tensor(float(10-10*(len(self.policy.coordinate_mat)/init_occ)), requires_grad= True).to("cuda")  #+ve diff is good
                 res = "view"
             else:
@@ -430,13 +420,13 @@ class GraspController:
         self.policy.init_tsdf()
         self.policy.target_bb = self.reset()
         self.complete = False
-        voxel_size = 0.0075
+        length = self.policy.tsdf.length
         x_off = 0.35
         y_off = -0.15
         z_off = 0.2
 
         bb_min = [x_off,y_off,z_off]
-        bb_max = [40*voxel_size+x_off,40*voxel_size+y_off,40*voxel_size+z_off]
+        bb_max = [length+x_off,length+y_off,length+z_off]
         self.bbox = AABBox(bb_min, bb_max)
 
         self.view_sphere = ViewHalfSphere(self.bbox, self.min_z_dist)
@@ -466,7 +456,7 @@ class GraspController:
 
             print("Graps", self.policy.grasps)
 
-            grasp_igs = [self.grasp_ig(grasp) for grasp in self.policy.grasps]
+            grasp_igs = self.policy.grasp_removal_gain_bounds(self.policy.grasps)
 
             views = self.policy.generate_views(state[2])
 
@@ -505,18 +495,7 @@ class GraspController:
 
                 self.switch_to_cartesian_velocity_control()
             elif action == "view":
-                start_time = time.time()
-                t = 0
-                self.policy.x_d = views[best_view]
-                timer = rospy.Timer(rospy.Duration(1.0 / self.control_rate), self.send_vel_cmd)
-                print("Executing for: 3 seconds")
-                while t < (3.0):
-                    img, pose, q = self.get_state()
-                    self.policy.integrate(img, pose, q)
-                    t += 1/self.policy_rate
-                    r.sleep()
-                rospy.sleep(0.2)        
-                timer.shutdown()
+                self.execute_view(views[best_view], r)
                 res = "view"
             else:
                 res = "aborted"
@@ -529,8 +508,45 @@ class GraspController:
 
 
 
+    def execute_view(self, x_d, r):
+        from active_search.search_policy import compute_error
+
+        start_time = time.time()
+        t = 0
+        self.policy.x_d = x_d
+        timer = rospy.Timer(rospy.Duration(1.0 / self.control_rate), self.send_vel_cmd)
+        prev_occ, settled, steps = None, 0, 0
+        while t < self.view_max_time:
+            img, pose, q = self.get_state()
+            self.policy.integrate(img, pose, q)
+            t += 1/self.policy_rate
+            steps += 1
+            # Done once the pose error and the change in occluded voxels stay small
+            occ = len(self.policy.coordinate_mat)
+            linear, angular = compute_error(x_d, pose)
+            reached = np.linalg.norm(linear) < self.view_position_tol and np.linalg.norm(angular) < self.view_angle_tol
+            if reached and prev_occ is not None and abs(occ - prev_occ) <= self.view_occlusion_tol:
+                settled += 1
+            else:
+                settled = 0
+            prev_occ = occ
+            if settled >= self.view_settle_steps:
+                break
+            r.sleep()
+        loop_time = time.time() - start_time
+        rospy.sleep(0.2)
+        timer.shutdown()
+        exec_time = time.time() - start_time
+        # What the fixed duration loop would have taken, it ran every step up to max_time
+        max_steps = int(np.ceil(self.view_max_time * self.policy_rate))
+        baseline_time = exec_time + loop_time / max(steps, 1) * max(max_steps - steps, 0)
+        self.view_durations.append((exec_time, baseline_time))
+        print("View executed in {:.2f} s".format(exec_time))
+        return exec_time
+
     def reset(self):
         Timer.reset()
+        self.view_durations = []
         self.moveit.scene.clear()
         res = self.reset_env(ResetRequest())
         rospy.sleep(1.0)  # Wait for the TF tree to be updated.
@@ -583,34 +599,27 @@ class GraspController:
         return self.policy.best_grasp
     
     def get_scene_grasps(self, bbox):
+        from active_search.detection import first_grasp_in_bbox
+
         self.view_sphere = ViewHalfSphere(bbox, self.min_z_dist)
         self.policy.activate(bbox, self.view_sphere)
         origin = self.policy.T_base_task
         origin.translation[2] -= 0.05
-        voxel_size, tsdf_grid = self.policy.tsdf.voxel_size, self.policy.tsdf.get_grid()
+        voxel_size = self.policy.tsdf.voxel_size
         # Then check whether VGN can find any grasps on the target
-        out = self.policy.vgn.predict(tsdf_grid)
-        grasps, qualities = select_local_maxima(voxel_size, out, threshold=0.8)
-
-        for grasp in grasps:
-            pose = origin * grasp.pose
-            tip = pose.rotation.apply([0, 0, 0.05]) + pose.translation
-            if bbox.is_inside(tip):
-                return True, grasp
-        return False, None
+        out = self.policy.predict_grasps()
+        grasp = first_grasp_in_bbox(voxel_size, out, origin, bbox, threshold=0.8)
+        return grasp is not None, grasp
     
     def grasp_ig(self, grasp):
-        #naive estimation of information gain from the grasping of an opject
-        t = (self.policy.T_task_base * grasp.pose).translation
-        i, j, k = (t / self.policy.tsdf.voxel_size).astype(int)
-        bb_voxel = [5,5,5] #place holder for the actual target object size 
-        # grasp_ig_mat = self.policy.occ_mat[i:i+2*bb_voxel[0],j-(bb_voxel[1]//2):j+(bb_voxel[1]//2),:] #most "correct approach" but gives some issues
-        grasp_ig_mat = self.policy.occ_mat[i:,j-(bb_voxel[1]//2):j+(bb_voxel[1]//2),:] #most "correct approach" but gives some issues
-        grasp_ig = grasp_ig_mat.sum()
+        # Upper bound on the occlusion reduction from removing the grasped object, see lookahead
+        grasp_ig = self.policy.grasp_removal_gain_bounds([grasp])[0]
         print("Grasp information gain:", grasp_ig)
         return grasp_ig
 
     def compute_reward(self, grasp, view, terminal, occ_diff, action_time):
+        import torch
+
         if terminal:
             return 10.0
         elif grasp:
@@ -752,10 +761,16 @@ class GraspController:
         }
         info.update(self.policy.info)
         info.update(Timer.timers)
+        # Time spent on view actions and the time early termination saved against the fixed loop
+        durations = np.asarray(self.view_durations).reshape(-1, 2)
+        info["view_time"] = np.sum(durations[:, 0])
+        info["view_time_saved"] = np.sum(durations[:, 1] - durations[:, 0])
         return info
 
 
 def compute_convex_hull(cloud):
+    import trimesh
+
     hull, _ = cloud.compute_convex_hull()
     triangles, vertices = np.asarray(hull.triangles), np.asarray(hull.vertices)
     return trimesh.base.Trimesh(vertices, triangles)
@@ -771,5 +786,8 @@ class ViewHalfSphere:
         up = np.r_[1.0, 0.0, 0.0]
         return look_at(eye, self.center, up)
 
-    def sample_view(self):
-        raise NotImplementedError
+    def sample_view(self, max_theta=np.pi / 4, rng=np.random):
+        # Uniform over the cap of the sphere within max_theta of the top
+        theta = np.arccos(1.0 - rng.uniform() * (1.0 - np.cos(max_theta)))
+        phi = rng.uniform(0.0, 2.0 * np.pi)
+        return self.get_view(theta, phi)
@@ -1,24 +1,20 @@
+import importlib
 import numpy as np
 from sensor_msgs.msg import CameraInfo
 from pathlib import Path
 import rospy
-from trac_ik_python.trac_ik import IK
-import torch
-import open3d as o3d
 import rospkg
-import os
 
 from robot_helpers.ros import tf
 from robot_helpers.ros.conversions import *
-from vgn.detection import *
-from vgn.perception import UniformTSDFVolume
 from robot_helpers.spatial import Transform
-# from active_search.dynamic_perception import SceneTSDFVolume
 
 from active_grasp.timer import Timer
-from active_grasp.rviz import Visualizer
 from active_grasp.bbox import AABBox
 
+# torch, open3d, trac_ik and vgn are imported where they are first needed so that importing the
+# policies stays cheap, NextBestView warms them up in the background while ROS connects
+
 
 def solve_ik(q0, pose, solver):
     x, y, z = pose.translation
@@ -42,32 +38,32 @@ class Policy:
         msg = rospy.wait_for_message(info_topic, CameraInfo, rospy.Duration(2.0))
         self.intrinsic = from_camera_info_msg(msg)
         self.qual_thresh = rospy.get_param("vgn/qual_threshold")
+        if not hasattr(self, "resolution"):
+            # NextBestView already read it before starting its warm-up thread
+            self.resolution = rospy.get_param("policy/resolution", 40)
+        self.tsdf_backend = rospy.get_param("policy/tsdf_backend", "uniform")
         self.target_bb = AABBox([0,0,0],[0,0,0])
         self.policy_log_dir = Path(rospkg.RosPack().get_path("active_search")) / "logs/policy_log.csv"
 
     def init_ik_solver(self):
+        from trac_ik_python.trac_ik import IK
+
         self.q0 = [0.0, -0.79, 0.0, -2.356, 0.0, 1.57, 0.79]
         self.cam_ik_solver = IK(self.base_frame, self.cam_frame)
         self.ee_ik_solver = IK(self.base_frame, "panda_link8")
 
     def init_tsdf(self):
-        self.tsdf = UniformTSDFVolume(0.3, 40)
-        rospack = rospkg.RosPack()
-        pkg_root = Path(rospack.get_path("active_search"))
-        directory_path =  str(pkg_root)+"/training/"
-        files = os.listdir(directory_path)
-        matching_files = [file for file in files if file.startswith("p")]
-
-        if matching_files:
-            def extract_number(filename):
-                return int(filename[1:-9])  # Extract the numeric part, excluding the 'p' prefix and '.pcd' extension
-
-            sorted_files = sorted(matching_files, key=extract_number, reverse=True)
-            latest_file = sorted_files[0]
-            print("Latest file:", latest_file)
-            self.point_index = extract_number(latest_file) + 1
-        else:
-            self.point_index = 0
+        from active_search.dynamic_perception import create_tsdf_volume
+
+        self.tsdf = create_tsdf_volume(self.tsdf_backend, 0.3, self.resolution)
+
+    def get_dataset_writer(self):
+        if not hasattr(self, "dataset_writer"):
+            from active_search.dataset import VoxelDatasetWriter
+
+            pkg_root = Path(rospkg.RosPack().get_path("active_search"))
+            self.dataset_writer = VoxelDatasetWriter(pkg_root / "training", self.tsdf.resolution)
+        return self.dataset_writer
 
 
     def solve_cam_ik(self, q0, view):
@@ -77,7 +73,10 @@ class Policy:
         return solve_ik(q0, pose, self.ee_ik_solver)
 
     def init_visualizer(self):
-        self.vis = Visualizer()
+        from active_search.visualization import make_visualizer
+
+        # RViz messages are published from a worker thread by default, see AsyncVisualizer
+        self.vis = make_visualizer(rospy.get_param("vis/mode", "async"), rospy.get_param("vis/rate", 10.0))
 
     def activate(self, bbox, view_sphere):
         self.vis.clear()
@@ -89,7 +88,10 @@ class Policy:
         # self.calibrate_task_frame()
         self.vis.bbox(self.base_frame, self.bbox)
         
-        self.vgn = VGN(Path(rospy.get_param("vgn/model")))
+        from active_search.detection import load_vgn
+
+        # Shared across episodes and policies, only reloaded when the checkpoint changes
+        self.vgn = load_vgn(rospy.get_param("vgn/model"))
 
         self.views = []
         self.best_grasp = None
@@ -104,7 +106,7 @@ class Policy:
         self.x_d = None
         self.done = False
         self.info = {}
-        self.qual_hist = np.zeros((self.T,) + (40,) * 3, np.float32)
+        self.init_qual_hist()
 
     #I think this is contraining the frame in which the robot can operate
     def calibrate_task_frame(self):
@@ -129,12 +131,22 @@ class Policy:
     def update(self, img, x, q):
         raise NotImplementedError
 
+    def predict_grasps(self):
+        # The prediction for the current map is cached with the tsdf, so the policy and the
+        # controller's get_scene_grasps share one forward pass per map version
+        def predict():
+            from active_search.dynamic_perception import read_only
+
+            out = self.vgn.predict(self.tsdf.get_grid())
+            return type(out)(*(read_only(a) for a in out))
+
+        return self.tsdf.cached("vgn", predict)
+
     def filter_grasps(self, out, q):
-        grasps, qualities = select_local_maxima(
-            self.tsdf.voxel_size,
-            out,
-            0.8,
-        )
+        from active_search.detection import select_candidates
+
+        # Candidates are transformed and bbox tested as arrays, only the survivors become Grasps
+        candidates = select_candidates(self.tsdf.voxel_size, out, 0.8).transform(self.T_base_task)
         filtered_grasps, filtered_qualities = [], []
 
         bbox_min = self.bbox.min + [0, 0, 3*self.tsdf.voxel_size]
@@ -149,27 +161,20 @@ class Policy:
         target = AABBox(target_min, target_max)
 
         self.vis.bbox(self.base_frame, target)
-        # print("grasps", grasps, qualities)
-        for grasp, quality in zip(grasps, qualities):
-            pose = self.T_base_task * grasp.pose
-            tip = pose.rotation.apply([0, 0, 0.05]) + pose.translation
-            #need to add some padding to botting of bbox as grasps appear there sometimes
-            # print(bbox.min)
-            if bbox.is_inside(tip) and quality > 0.8:
-                grasp.pose = pose
-                q_grasp = self.solve_ee_ik(q, pose * self.T_grasp_ee)                
-                if q_grasp is not None:
-                    filtered_grasps.append(grasp)
-                    filtered_qualities.append(quality)
-            if target.is_inside(tip) and quality > 0.8:
-                grasp.pose = pose
-                q_grasp = self.solve_ee_ik(q, pose * self.T_grasp_ee)
-                if q_grasp is not None:
-                    print("Found grasp on target")
-                    self.done = True
-                    filtered_grasps = [grasp]
-                    filtered_qualities = [quality]
-                    return filtered_grasps, filtered_qualities
+        #need to add some padding to botting of bbox as grasps appear there sometimes
+        in_bbox = candidates.tips_inside(bbox)
+        in_target = candidates.tips_inside(target)
+        for n in np.flatnonzero(in_bbox | in_target):
+            grasp, quality = candidates.grasp(n), candidates.qualities[n]
+            q_grasp = self.solve_ee_ik(q, grasp.pose * self.T_grasp_ee)
+            if q_grasp is None:
+                continue
+            if in_target[n]:
+                print("Found grasp on target")
+                self.done = True
+                return [grasp], [quality]
+            filtered_grasps.append(grasp)
+            filtered_qualities.append(quality)
 
         return filtered_grasps, filtered_qualities
 
@@ -186,10 +191,16 @@ class MultiViewPolicy(Policy):
     def __init__(self):
         super().__init__()
         self.T = rospy.get_param("policy/window_size")
+        self.qual_hist_threshold = rospy.get_param("policy/qual_hist_threshold", 0.5)
 
     def activate(self, bbox, view_sphere):
         super().activate(bbox, view_sphere)
-        self.qual_hist = np.zeros((self.T,) + (40,) * 3, np.float32)
+        self.init_qual_hist()
+
+    def init_qual_hist(self):
+        from .kernels import QualityHistory
+
+        self.qual_hist = QualityHistory(self.T, self.tsdf.resolution, self.qual_hist_threshold)
 
     def integrate(self, img, x, q):
         self.views.append(x)
@@ -204,23 +215,22 @@ class MultiViewPolicy(Policy):
         scene_cloud = self.tsdf.get_scene_cloud()
         self.vis.scene_cloud(self.task_frame, np.asarray(scene_cloud.points))
 
-        map_cloud = self.tsdf.get_map_cloud()
+        points, distances = self.tsdf.get_map_points()
         self.vis.map_cloud(
             self.task_frame,
-            np.asarray(map_cloud.points),
-            np.expand_dims(np.asarray(map_cloud.colors)[:, 0], 1),
+            points,
+            np.expand_dims(distances, 1),
         )
 
 
     def get_grasps(self, q):
         # print("################### predicting grasps ################################")
         with Timer("grasp_prediction"):
-            tsdf_grid = self.tsdf.get_grid()
-            out = self.vgn.predict(tsdf_grid)
+            out = self.predict_grasps()
         self.vis.quality(self.task_frame, self.tsdf.voxel_size, out.qual, 0.9)
 
         t = (len(self.views) - 1) % self.T
-        self.qual_hist[t, ...] = out.qual
+        self.qual_hist.update(t, out.qual)
 
         with Timer("grasp_selection"):
             self.grasps, self.qualities = self.filter_grasps(out, q)
@@ -233,42 +243,138 @@ class MultiViewPolicy(Policy):
             self.best_grasp = None
             self.vis.clear_grasp()
 
+    # View planning helpers shared by the nbv policies, the kernels live in active_search.kernels
 
-    def get_poi_torch(self):
-        resolution = self.tsdf.resolution
-        voxel_size = self.tsdf.voxel_size
+    def best_grasp_prediction_is_stable(self):
+        if self.best_grasp:
+            return self.grasps_are_stable([self.best_grasp])[0]
+        return False
 
-        volume = self.tsdf.o3dvol.extract_volume_tsdf()
-        vol_array = np.asarray(volume)
+    def grasps_are_stable(self, grasps):
+        # Checks all grasps (in the base frame) against the quality history at once
+        if len(grasps) == 0:
+            return np.zeros(0, dtype=bool)
+        return self.qual_hist.is_stable(self.task_positions(grasps), self.tsdf.voxel_size)
 
-        vol_mat = vol_array[:,0].reshape(resolution, resolution, resolution)
+    def grasp_removal_gain_bounds(self, grasps):
+        # Upper bounds on the occluded voxels revealed by removing the object of each grasp and
+        # observing the emptied region, see active_search.lookahead
+        from .lookahead import grasp_removal_gain_bounds
 
-        bb_size = ((self.target_bb.max - self.target_bb.min)/voxel_size).astype(int)
+        if len(grasps) == 0 or not hasattr(self, "occ_mat"):
+            return np.zeros(len(grasps))
+        indices = (self.task_positions(grasps) / self.tsdf.voxel_size).astype(int)
+        padding = int(np.ceil(self.tsdf.sdf_trunc / self.tsdf.voxel_size))
+        return grasp_removal_gain_bounds(self.tsdf.get_volume(), self.occ_mat, self.bb_size, indices, padding)
 
-        bb_voxel = np.floor(bb_size).astype(int)
+    def task_positions(self, grasps):
+        positions = np.array([g.pose.translation for g in grasps]) @ self.T_task_base.rotation.as_matrix().T
+        return positions + self.T_task_base.translation
 
-        # bb_voxel = [5,5,5]
+    def generate_views(self, q, return_configs=False):
+        from .kernels import generate_views
+
+        result = generate_views(self.view_sphere, q, self.solve_cam_ik, return_configs=return_configs)
+        print("generating",len(result[0] if return_configs else result),"views")
+        return result
+
+    def ig_fn(self, view, downsample):
+        from .kernels import information_gain
+
+        return information_gain(
+            self.tsdf.get_grid(),
+            self.tsdf.voxel_size,
+            self.intrinsic,
+            view,
+            self.bbox,
+            self.T_task_base,
+            self.coordinate_mat,
+            downsample,
+        )
+
+    def ig_batch(self, views, downsample):
+        from .kernels import information_gain_batch
+
+        return information_gain_batch(
+            self.tsdf.get_grid(),
+            self.tsdf.voxel_size,
+            self.intrinsic,
+            views,
+            self.bbox,
+            self.T_task_base,
+            self.coordinate_mat,
+            downsample,
+        )
 
-        vol_mat = torch.from_numpy(vol_mat).to(torch.device("cuda"))
+    def view_gains(self, views, downsample):
+        # Same gains as ig_batch, but the raycasts go through the view_voxels cache so that
+        # callers that need the voxels afterwards don't cast the rays again
+        occluded = np.zeros((self.tsdf.resolution,) * 3, dtype=bool)
+        occluded[tuple(self.coordinate_mat.T)] = True
+        return np.array(
+            [np.count_nonzero(occluded[tuple(self.view_voxels(v, downsample).T)]) for v in views], dtype=int
+        )
 
-        occ_mat = torch.zeros_like(vol_mat, device="cuda")
-        tsdf_check = occ_mat
-        max_tsdf_slices = occ_mat
+    def sample_views(self, q, downsample, score_fn=None):
+        # Coarse-to-fine views biased towards the occlusion frontier, only the refined set is scored,
+        # with ig_batch unless another score_fn is given
+        from .kernels import adaptive_views
+
+        if score_fn is None:
+            score_fn = lambda views: self.ig_batch(views, downsample)
+        views, configs, gains = adaptive_views(
+            self.view_sphere,
+            q,
+            self.solve_cam_ik,
+            score_fn,
+            frontier=self.occlusion_frontier(),
+            num_refine=rospy.get_param("nbv_grasp/num_refine", 4),
+        )
+        print("sampled", len(views), "views")
+        return views, configs, gains
+
+    def occlusion_frontier(self):
+        # Base frame centers of the occluded voxels next to a voxel that isn't occluded
+        from scipy import ndimage
+
+        if not hasattr(self, "occ_mat"):
+            return None
+        occ = self.occ_mat > 0
+        frontier = np.argwhere(occ & ~ndimage.binary_erosion(occ))
+        return self.T_base_task.apply((frontier + 0.5) * self.tsdf.voxel_size)
+
+    def view_voxels(self, view, downsample):
+        # Raycast part of ig_fn, cached until the map changes
+        from .kernels import view_voxels
+
+        def cast():
+            return view_voxels(
+                self.tsdf.get_grid(),
+                self.tsdf.voxel_size,
+                self.intrinsic,
+                view,
+                self.bbox,
+                self.T_task_base,
+                downsample,
+            )
+
+        key = ("view_voxels", tuple(np.round(view.to_list(), 6)), downsample)
+        return self.tsdf.cached(key, cast)
 
-        tsdf_slices = vol_mat.unfold(0, int(bb_voxel[0]), 1).unfold(1, int(bb_voxel[1]), 1).unfold(2, int(bb_voxel[2]), 1)
-        # max_tsdf_slices[0:resolution-bb_voxel[0]+1,0:resolution-bb_voxel[1]+1,0:resolution-bb_voxel[2]+1]  = tsdf_slices.amax(dim=(3, 4, 5))
-        max_tsdf_slices = tsdf_slices.amax(dim=(3, 4, 5))
-        # print(max_tsdf_slices.shape)
 
-        tsdf_check[0:resolution-bb_voxel[0]+1,0:resolution-bb_voxel[1]+1,0:resolution-bb_voxel[2]+1] = max_tsdf_slices <= 0.5
+    def get_poi_torch(self):
+        voxel_size = self.tsdf.voxel_size
+
+        vol_mat = self.tsdf.get_volume()[..., 0]
 
-        occ_mat[0:resolution, 0:resolution, 0:resolution] = tsdf_check.squeeze().to(dtype=torch.uint8)
+        bb_size = ((self.target_bb.max - self.target_bb.min)/voxel_size).astype(int)
 
-        pooling = torch.nn.MaxPool3d(kernel_size=tuple(np.clip(bb_size//2, 1, np.inf).astype(int)), stride=(1,1,1))
+        bb_voxel = np.floor(bb_size).astype(int)
 
-        occ_mat = pooling(occ_mat.unsqueeze(0).unsqueeze(0)).squeeze()
+        # bb_voxel = [5,5,5]
 
-        occ_mat_result = occ_mat.cpu().numpy()
+        occ_mat_result = find_occluded_voxels(vol_mat, bb_size)
+        self.bb_size = bb_size
 
         self.coordinate_mat = np.argwhere(occ_mat_result > 0)
 
@@ -285,20 +391,8 @@ class MultiViewPolicy(Policy):
         store_pc = False
 
         if store_pc:
-            rospack = rospkg.RosPack()
-            pkg_root = Path(rospack.get_path("active_search"))
-            file_dir_occ = str(pkg_root)+"/training/p"+str(self.point_index)+"_occu.pcd"
-            file_dir_tsdf = str(pkg_root)+"/training/p"+str(self.point_index)+"_tsdf.pcd"
-            print(file_dir_occ)
-            print(file_dir_tsdf)
-            coord_o3d = o3d.utility.Vector3dVector(self.coordinate_mat)
-            poi_mat_o3d = o3d.geometry.PointCloud(points = coord_o3d)
-            write_occ = o3d.io.write_point_cloud(file_dir_occ, poi_mat_o3d, write_ascii=False, compressed=False, print_progress=False)
-            write_tsdf = o3d.io.write_point_cloud(file_dir_tsdf, self.tsdf.get_map_cloud(), write_ascii=False, compressed=False, print_progress=False)
-            print(write_occ, write_tsdf)
-            #only increment if we have created a set
-            if write_occ and write_tsdf:
-                self.point_index += 1
+            sample = self.get_dataset_writer().append(self.tsdf.get_grid(), self.coordinate_mat)
+            print("stored sample", sample)
 
         self.coord_set = coordinate_mat_set
         self.occ_mat = occ_mat_result 
@@ -317,17 +411,15 @@ class MultiViewPolicy(Policy):
 
         points_within_box = np.logical_and(np.logical_and(x_mask, y_mask), z_mask)
 
+        # Clear everything from the table up to the top of the removed object
+        region = AABBox(np.r_[bb.min[:2], 0.0], bb.max)
+        lo, hi = self.tsdf.clear_region(region, padding=self.tsdf.sdf_trunc)
+        self.update_poi(lo, hi)
+
         bb_vis = bb
         bb_vis.min += [0.35,-0.15,0.2]
         bb_vis.max += [0.35,-0.15,0.2]
         self.vis.bbox(self.base_frame, bb_vis)
-        tsdf_vec = np.asarray(self.tsdf.o3dvol.extract_volume_tsdf())
-        tsdf_grid = np.reshape(tsdf_vec, [40,40,40,2])
-        # print(min_bound, max_bound)
-        tsdf_grid[min_bound[0]:max_bound[0], min_bound[1]:max_bound[1], 0:max_bound[2]] = 0
-        tsdf_vec = o3d.utility.Vector2dVector(np.reshape(tsdf_grid, [40*40*40,2]))
-        self.tsdf = UniformTSDFVolume(0.3, 40)
-        self.tsdf.o3dvol.inject_volume_tsdf(tsdf_vec)
         #update rviz
         scene_cloud = self.tsdf.get_scene_cloud()
         self.vis.scene_cloud(self.task_frame, np.asarray(scene_cloud.points))
@@ -335,7 +427,66 @@ class MultiViewPolicy(Policy):
         # return np.prod(max_bound - min_bound)
         return np.sum(points_within_box)
 
+    def update_poi(self, lo, hi):
+        # Only recomputes the occlusion around the voxels [lo, hi) that changed since get_poi_torch
+        if not hasattr(self, "occ_mat"):
+            return
+        vol_mat = self.tsdf.get_volume()[..., 0]
+        self.occ_mat = update_occluded_voxels(self.occ_mat, vol_mat, self.bb_size, lo, hi)
+        self.coordinate_mat = np.argwhere(self.occ_mat > 0)
+        self.coord_set = set(map(tuple, self.coordinate_mat))
+
+
+
+
+def find_occluded_voxels(vol_mat, bb_size, device="cuda"):
+    # Marks the voxels where a target of bb_size voxels could be hidden, works for any grid size
+    import torch
+
+    vol_mat = torch.from_numpy(np.ascontiguousarray(vol_mat)).to(torch.device(device))
+    return find_occluded_voxels_batch(vol_mat.unsqueeze(0), bb_size)[0].cpu().numpy()
+
+
+def find_occluded_voxels_batch(vol_mats, bb_size):
+    # Same as find_occluded_voxels for a (N, X, Y, Z) tensor of volumes, returns a tensor
+    import torch
+
+    bb_voxel = np.floor(bb_size).astype(int)
+
+    occ_mat = torch.zeros_like(vol_mats)
+    tsdf_check = occ_mat
+
+    tsdf_slices = vol_mats.unfold(1, int(bb_voxel[0]), 1).unfold(2, int(bb_voxel[1]), 1).unfold(3, int(bb_voxel[2]), 1)
+    max_tsdf_slices = tsdf_slices.amax(dim=(4, 5, 6))
+
+    n = max_tsdf_slices.shape
+    tsdf_check[:, 0:n[1], 0:n[2], 0:n[3]] = (max_tsdf_slices <= 0.5).to(dtype=occ_mat.dtype)
+
+    pooling = torch.nn.MaxPool3d(kernel_size=tuple(pooling_size(bb_size)), stride=(1,1,1))
+
+    return pooling(occ_mat.unsqueeze(1))[:, 0]
+
+
+def pooling_size(bb_size):
+    return np.clip(np.asarray(bb_size)//2, 1, np.inf).astype(int)
+
+
+def update_occluded_voxels(occ_mat, vol_mat, bb_size, lo, hi, device="cuda"):
+    # An output voxel p of find_occluded_voxels depends on vol_mat[p:p+reach+1], so only the
+    # outputs in [lo-reach, hi) change when vol_mat[lo:hi] does. They are recomputed on a
+    # sub-volume that is large enough for all of them to see the same data as on the full grid.
+    resolution = np.asarray(vol_mat.shape)
+    reach = (pooling_size(bb_size) - 1) + (np.floor(bb_size).astype(int) - 1)
+    start = np.maximum(0, np.asarray(lo) - reach)
+    stop = np.minimum(resolution, np.asarray(hi) + reach)
+    end = np.minimum(np.asarray(hi), occ_mat.shape)
+    if (end <= start).any():
+        return occ_mat
 
+    sub = find_occluded_voxels(vol_mat[tuple(slice(a, c) for a, c in zip(start, stop))], bb_size, device)
+    occ_mat = occ_mat.copy()
+    occ_mat[tuple(slice(a, e) for a, e in zip(start, end))] = sub[tuple(slice(0, e - a) for a, e in zip(start, end))]
+    return occ_mat
 
 
 def compute_error(x_d, x):
@@ -354,6 +505,11 @@ def register(id, cls):
 
 def make(id, *args, **kwargs):
     if id in registry:
-        return registry[id](*args, **kwargs)
+        cls = registry[id]
+        if isinstance(cls, str):
+            # Registered as "module:Class", only imported once the policy is requested
+            module_name, cls_name = cls.split(":")
+            cls = getattr(importlib.import_module(module_name), cls_name)
+        return cls(*args, **kwargs)
     else:
         raise ValueError("{} policy does not exist.".format(id))
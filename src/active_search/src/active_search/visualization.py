@@ -0,0 +1,91 @@
+from collections import OrderedDict
+import itertools
+import threading
+import time
+
+import rospy
+
+
+class AsyncVisualizer:
+    """Forwards calls to a Visualizer from a worker thread.
+
+    Methods in LATEST_WINS redraw a single marker, so only their latest arguments are kept and a
+    slow RViz connection drops intermediate updates instead of stalling the control loop. Other
+    calls, e.g. bbox for the task and the target box, are all kept. The worker publishes the
+    pending calls at most rate times per second, in the order they were last made.
+    """
+
+    LATEST_WINS = {"ig_views", "scene_cloud", "map_cloud", "quality"}
+
+    def __init__(self, vis, rate=10.0, max_pending=32):
+        self.vis = vis
+        self.period = 1.0 / rate
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        method = getattr(self.vis, name)
+        if not callable(method):
+            return method
+
+        def submit(*args, **kwargs):
+            self.submit(name, method, args, kwargs)
+
+        return submit
+
+    def submit(self, name, method, args, kwargs):
+        with self.cond:
+            if name == "clear":
+                # Everything still pending would be cleared right away anyway
+                self.dropped += len(self.pending)
+                self.pending.clear()
+            key = name if name in self.LATEST_WINS else (name, next(self.counter))
+            if key in self.pending:
+                del self.pending[key]
+                self.dropped += 1
+            elif len(self.pending) >= self.max_pending:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = (method, args, kwargs)
+            self.cond.notify()
+
+    def run(self):
+        while not rospy.is_shutdown():
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                calls = list(self.pending.values())
+                self.pending.clear()
+            start = time.time()
+            for method, args, kwargs in calls:
+                try:
+                    method(*args, **kwargs)
+                except Exception as e:
+                    rospy.logwarn_throttle(5.0, "Visualization failed: {}".format(e))
+            time.sleep(max(0.0, self.period - (time.time() - start)))
+
+
+class NullVisualizer:
+    """Accepts every Visualizer call and does nothing."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def make_visualizer(mode="async", rate=10.0):
+    # mode is one of "async", "sync" (publish from the calling thread) or "off"
+    if mode == "off":
+        return NullVisualizer()
+
+    from active_grasp.rviz import Visualizer
+
+    if mode == "sync":
+        return Visualizer()
+    elif mode == "async":
+        return AsyncVisualizer(Visualizer(), rate)
+    raise ValueError("Unknown visualization mode {}".format(mode))